@@ -88,6 +88,7 @@ import codecs
 import types
 import re
 import sgmllib
+import xml.parsers.expat
 try:
   from htmlentitydefs import name2codepoint
 except ImportError:
@@ -100,10 +101,43 @@ DEFAULT_OUTPUT_ENCODING = "utf-8"
 
 # First, the classes that represent markup elements.
 
-class PageElement:
+class PageElement(object):
     """Contains the navigational information for some part of the page
     (either a tag or a piece of text)"""
 
+    # A document has a node for every tag and every string in it, so nodes
+    # keep their attributes in __slots__ rather than a dict each. The
+    # slots are declared by NavigableString and Tag, since unicode can't
+    # share a layout with another class that has them.
+    __slots__ = ()
+
+    # Bumped whenever a tree is changed, so the name indexes that Tags build
+    # for attribute-style navigation know they have to start again.
+    _treeGeneration = 0
+
+    def __getstate__(self):
+        """Returns the slots which are set, for pickling and copying, since
+        there's no __dict__ for them to use. The name index can't be
+        copied, and is left to be rebuilt."""
+        state = {}
+        try:
+            state.update(object.__getattribute__(self, '__dict__'))
+        except AttributeError:
+            pass
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                try:
+                    state[name] = object.__getattribute__(self, name)
+                except AttributeError:
+                    pass
+        if '_nameIndex' in state:
+            state['_nameIndex'] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def setup(self, parent=None, previous=None):
         """Sets up the initial relations between this element and
         other elements."""
@@ -112,7 +146,7 @@ class PageElement:
         self.next = None
         self.previousSibling = None
         self.nextSibling = None
-        if self.parent and self.parent.contents:
+        if self.parent is not None and self.parent.contents:
             self.previousSibling = self.parent.contents[-1]
             self.previousSibling.nextSibling = self
 
@@ -157,6 +191,7 @@ class PageElement:
         if self.nextSibling:
             self.nextSibling.previousSibling = self.previousSibling
         self.previousSibling = self.nextSibling = None
+        PageElement._treeGeneration += 1
 
     def _lastRecursiveChild(self):
         "Finds the last element beneath this object to be parsed."
@@ -224,6 +259,7 @@ class PageElement:
         if newChildsLastElement.next:
             newChildsLastElement.next.previous = newChildsLastElement
         self.contents.insert(position, newChild)
+        PageElement._treeGeneration += 1
 
     def append(self, tag):
         """Appends the given tag to the contents of this tag."""
@@ -389,6 +425,9 @@ class PageElement:
 
 class NavigableString(unicode, PageElement):
 
+    __slots__ = ('parent', 'previous', 'next', 'previousSibling',
+                 'nextSibling')
+
     def __getnewargs__(self):
         return (NavigableString.__str__(self),)
 
@@ -412,10 +451,14 @@ class NavigableString(unicode, PageElement):
 
 class CData(NavigableString):
 
+    __slots__ = ()
+
     def __str__(self, encoding=DEFAULT_OUTPUT_ENCODING):
         return "<![CDATA[%s]]>" % NavigableString.__str__(self, encoding)
 
 class ProcessingInstruction(NavigableString):
+
+    __slots__ = ()
     def __str__(self, encoding=DEFAULT_OUTPUT_ENCODING):
         output = self
         if "%SOUP-ENCODING%" in output:
@@ -423,10 +466,14 @@ class ProcessingInstruction(NavigableString):
         return "<?%s?>" % self.toEncoding(output, encoding)
 
 class Comment(NavigableString):
+
+    __slots__ = ()
     def __str__(self, encoding=DEFAULT_OUTPUT_ENCODING):
         return "<!--%s-->" % NavigableString.__str__(self, encoding)
 
 class Declaration(NavigableString):
+
+    __slots__ = ()
     def __str__(self, encoding=DEFAULT_OUTPUT_ENCODING):
         return "<!%s>" % NavigableString.__str__(self, encoding)
 
@@ -434,6 +481,15 @@ class Tag(PageElement):
 
     """Represents a found HTML tag with its attributes and contents."""
 
+    # string is only set on tags with a single string in them; otherwise
+    # tag.string goes to __getattr__ like any other missing attribute.
+    __slots__ = ('parent', 'previous', 'next', 'previousSibling',
+                 'nextSibling', 'parserClass', 'isSelfClosing', 'name',
+                 'attrs', 'attrMap', 'contents', 'string', 'hidden',
+                 'containsSubstitutions', 'convertHTMLEntities',
+                 'convertXMLEntities', 'escapeUnrecognizedEntities',
+                 '_nameIndex')
+
     def _invert(h):
         "Cheap function to invert a hash."
         i = {}
@@ -486,7 +542,12 @@ class Tag(PageElement):
         if attrs == None:
             attrs = []
         self.attrs = attrs
+        self.attrMap = None
         self.contents = []
+        # (tree generation, name -> first Tag of that name, walk of the
+        # rest of the tree) once attribute-style navigation has been used;
+        # see _findByName.
+        self._nameIndex = None
         self.setup(parent, previous)
         self.hidden = False
         self.containsSubstitutions = False
@@ -495,11 +556,12 @@ class Tag(PageElement):
         self.escapeUnrecognizedEntities = parser.escapeUnrecognizedEntities
 
         # Convert any HTML, XML, or numeric entities in the attribute values.
-        convert = lambda(k, val): (k,
-                                   re.sub("&(#\d+|#x[0-9a-fA-F]+|\w+);",
-                                          self._convertEntities,
-                                          val))
-        self.attrs = map(convert, self.attrs)
+        if self.attrs:
+            convert = lambda(k, val): (k,
+                                       re.sub("&(#\d+|#x[0-9a-fA-F]+|\w+);",
+                                              self._convertEntities,
+                                              val))
+            self.attrs = map(convert, self.attrs)
 
     def get(self, key, default=None):
         """Returns the value of the 'key' attribute for the tag, or
@@ -564,11 +626,34 @@ class Tag(PageElement):
     def __getattr__(self, tag):
         #print "Getattr %s.%s" % (self.__class__, tag)
         if len(tag) > 3 and tag.rfind('Tag') == len(tag)-3:
-            return self.find(tag[:-3])
+            return self._findByName(tag[:-3])
         elif tag.find('__') != 0:
-            return self.find(tag)
+            return self._findByName(tag)
         raise AttributeError, "'%s' object has no attribute '%s'" % (self.__class__, tag)
 
+    def _findByName(self, name):
+        """Returns the same as self.find(name), for tag.name navigation.
+
+        Instead of searching from the start each time, the walk through
+        this tag's contents is kept, along with the first Tag of each
+        name it has passed, so looking up a name again, or one we've
+        already gone past, doesn't search at all. The index is started
+        again whenever any tree is changed."""
+        index = self._nameIndex
+        if index is None or index[0] != PageElement._treeGeneration:
+            index = (PageElement._treeGeneration, {},
+                     self.recursiveChildGenerator())
+            self._nameIndex = index
+        generation, found, walk = index
+        if found.has_key(name):
+            return found[name]
+        for element in walk:
+            if isinstance(element, Tag) and not found.has_key(element.name):
+                found[element.name] = element
+                if element.name == name:
+                    return element
+        return None
+
     def __eq__(self, other):
         """Returns true iff this tag has the same name, the same attributes,
         and the same contents (recursively) as the given tag.
@@ -977,6 +1062,12 @@ class BeautifulStoneSoup(Tag, SGMLParser):
                        lambda x: '<!' + x.group(1) + '>')
                       ]
 
+    # The encoding given in the XML declaration a document starts with.
+    XML_ENCODING_DECLARATION = re.compile(
+        '<\?xml[^>]*?\sencoding\s*=\s*["\']([^"\']+)["\']')
+
+    NON_ASCII = re.compile('[\x80-\xff]')
+
     ROOT_TAG_NAME = u'[document]'
 
     HTML_ENTITIES = "html"
@@ -990,10 +1081,12 @@ class BeautifulStoneSoup(Tag, SGMLParser):
     # fancy Unicode spaces (usually non-breaking) should be left
     # alone.
     STRIP_ASCII_SPACES = { 9: None, 10: None, 12: None, 13: None, 32: None, }
+    ASCII_SPACES = '\t\n\x0c\r '
 
     def __init__(self, markup="", parseOnlyThese=None, fromEncoding=None,
                  markupMassage=True, smartQuotesTo=XML_ENTITIES,
-                 convertEntities=None, selfClosingTags=None):
+                 convertEntities=None, selfClosingTags=None,
+                 trustedXML=False, tokenizer=None):
         """The Soup object is initialized as the 'root tag', and the
         provided markup (which can be a string or a file-like object)
         is fed into the underlying parser.
@@ -1017,11 +1110,33 @@ class BeautifulStoneSoup(Tag, SGMLParser):
 
         You can pass in a custom list of (RE object, replace method)
         tuples to get Beautiful Soup to scrub your input the way you
-        want."""
+        want.
+
+        If you know the markup is well-formed XML, pass in True for
+        trustedXML. The document is then decoded straight from the
+        encoding its XML declaration gives, without sniffing for other
+        encodings, and the default massage is cut down to the one fix
+        well-formed XML can need, which is only run if there's an
+        empty-element tag to fix. A document without a declaration, or
+        which doesn't decode, is still handled the usual way.
+
+        To parse a document as it arrives, create the soup with no
+        markup, then feed() it the pieces and close() it.
+
+        The markup is split into tags, strings and so on by the
+        SGMLParser this class is built on. To use something faster,
+        pass in a class for tokenizer, such as ExpatTokenizer. It's
+        created with the soup, and fed the decoded markup in place of
+        SGMLParser, and builds the tree by calling the same methods
+        on the soup that SGMLParser does: unknown_starttag,
+        unknown_endtag, handle_data and so on."""
 
         self.parseOnlyThese = parseOnlyThese
         self.fromEncoding = fromEncoding
         self.smartQuotesTo = smartQuotesTo
+        self.trustedXML = trustedXML
+        self.tokenizer = tokenizer
+        self._tokenizer = None
         self.convertEntities = convertEntities
         # Set the rules for how we'll deal with the entities we
         # encounter
@@ -1048,6 +1163,16 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             self.escapeUnrecognizedEntities = False
 
         self.instanceSelfClosingTags = buildTagMap(None, selfClosingTags)
+        # State for feed(): the start of the document while we're still
+        # deciding on its encoding, the decoder once we have, and any
+        # text after the last '>', which isn't massaged until the rest
+        # of its tag has arrived.
+        self._undecoded = ''
+        self._decoder = None
+        self._unmassaged = u''
+        # Whether the parser has all of the document, so that something
+        # unfinished at the end of what it has is all there will be.
+        self._complete = True
         SGMLParser.__init__(self)
 
         if hasattr(markup, 'read'):        # It's a file-type object.
@@ -1077,16 +1202,23 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             if not hasattr(self, 'originalEncoding'):
                 self.originalEncoding = None
         else:
-            dammit = UnicodeDammit\
-                     (markup, [self.fromEncoding, inDocumentEncoding],
-                      smartQuotesTo=self.smartQuotesTo)
-            markup = dammit.unicode
-            self.originalEncoding = dammit.originalEncoding
-        if markup:
+            encoding = self.trustedXML and self._trustedEncoding(markup)
+            if encoding:
+                try:
+                    markup = unicode(markup, encoding)
+                except UnicodeDecodeError:
+                    encoding = None
+            if encoding:
+                self.originalEncoding = encoding
+            else:
+                dammit = UnicodeDammit\
+                         (markup, [self.fromEncoding, inDocumentEncoding],
+                          smartQuotesTo=self.smartQuotesTo)
+                markup = dammit.unicode
+                self.originalEncoding = dammit.originalEncoding
+        if markup and not self.tokenizer:
             if self.markupMassage:
-                if not isList(self.markupMassage):
-                    self.markupMassage = self.MARKUP_MASSAGE
-                for fix, m in self.markupMassage:
+                for fix, m in self._massageFixes(markup):
                     markup = fix.sub(m, markup)
                 # TODO: We get rid of markupMassage so that the
                 # soup object can be deepcopied later on. Some
@@ -1096,12 +1228,194 @@ class BeautifulStoneSoup(Tag, SGMLParser):
                 del(self.markupMassage)
         self.reset()
 
-        SGMLParser.feed(self, markup)
+        if self.tokenizer:
+            self._tokenizer = self.tokenizer(self)
+            if markup:
+                self._tokenizer.feed(markup)
+                if self._tokenizer:
+                    self._tokenizer.close()
+                self._tokenizer = None
+                self.markupMassage = None
+        else:
+            SGMLParser.feed(self, markup)
         # Close out any unfinished strings and close all the open tags.
         self.endData()
         while self.currentTag.name != self.ROOT_TAG_NAME:
             self.popTag()
 
+    def _trustedEncoding(self, markup):
+        """Returns the encoding to decode trusted XML starting with
+        markup from, or None if it has to be found the usual way. That
+        includes the encodings UnicodeDammit converts smart quotes in,
+        so they're still converted."""
+        encoding = self.fromEncoding
+        if not encoding:
+            match = self.XML_ENCODING_DECLARATION.match(markup)
+            if not match:
+                return None
+            encoding = match.group(1).lower()
+        try:
+            name = codecs.lookup(encoding).name
+        except LookupError:
+            return None
+        if self.smartQuotesTo and name in ('cp1252', 'iso8859-1',
+                                           'iso8859-2'):
+            return None
+        return encoding
+
+    def _massageFixes(self, markup):
+        """Returns the markup massage fixes to run over markup."""
+        if not isList(self.markupMassage):
+            if self.trustedXML:
+                # Well-formed XML can't have a bad declaration, only
+                # an empty-element tag.
+                if markup.find('/>') == -1:
+                    return []
+                return self.MARKUP_MASSAGE[:1]
+            self.markupMassage = self.MARKUP_MASSAGE
+        return self.markupMassage
+
+    # How much of the document to wait for before choosing its encoding,
+    # if there isn't a '>' before then.
+    ENCODING_SNIFF_SIZE = 1024
+
+    def feed(self, markup):
+        """Parses the next piece of the document.
+
+        The tree is built as the pieces arrive, and is the same as if
+        the whole document had been passed to the constructor once
+        close() has been called. The encoding is chosen the way
+        UnicodeDammit would, from the first piece with a '>' in it. If
+        a later piece doesn't decode, the rest of the document is read
+        as windows-1252. Markup massage is applied up to the last '>'
+        fed so far, which is exact for fixes which work within a tag,
+        like the default ones."""
+        self._complete = False
+        if not isinstance(markup, unicode):
+            markup = self._decodePiece(markup, False)
+        self._feedText(markup)
+
+    def close(self):
+        """Parses whatever is left of the document, and closes all the
+        open tags."""
+        self._complete = True
+        text = u''
+        if self._undecoded or self._decoder:
+            text = self._decodePiece('', True)
+        self._decoder = None
+        self._feedText(text)
+        if self._tokenizer:
+            self._tokenizer.close()
+            self._tokenizer = None
+        # SGMLParser holds back anything it can't tell is finished until
+        # it gets more, so now that there isn't any more, go back over
+        # it.
+        self.goahead(0)
+        self.endData()
+        while self.currentTag.name != self.ROOT_TAG_NAME:
+            self.popTag()
+        self.markupMassage = None
+
+    def _decodePiece(self, data, final):
+        if self._decoder is None:
+            data = self._undecoded + data
+            if not final and len(data) < self.ENCODING_SNIFF_SIZE \
+                   and '>' not in data:
+                self._undecoded = data
+                return u''
+            self._undecoded = ''
+            data = self._chooseDecoder(data)
+        if self.originalEncoding == 'ascii' and \
+               self.NON_ASCII.search(data):
+            # See _chooseDecoder.
+            self.originalEncoding = 'utf-8'
+        if self.smartQuotesTo and self.originalEncoding in \
+               ("windows-1252", "iso-8859-1", "iso-8859-2"):
+            data = re.compile("([\x80-\x9f])").sub \
+                   (lambda(x): self._dammit._subMSChar(x.group(1)), data)
+        # The decoder is left as it was if it can't decode data, so
+        # this is whatever it had held back from the last piece.
+        pending = self._decoder.getstate()[0]
+        try:
+            return self._decoder.decode(data, final)
+        except UnicodeDecodeError:
+            # Too late to start again with another encoding.
+            self._setDecoder('windows-1252', '')
+            return self._decodePiece(pending + data, final)
+
+    def _chooseDecoder(self, data):
+        """Picks the encoding of a document starting with data, trying
+        the same encodings in the same order UnicodeDammit does, and
+        returns data without any byte order mark."""
+        dammit = UnicodeDammit('', smartQuotesTo=self.smartQuotesTo)
+        self._dammit = dammit
+        if self.trustedXML:
+            encoding = self._trustedEncoding(data)
+            if encoding and self._setDecoder(encoding, data):
+                return data
+        xml_data, documentEncoding, sniffedEncoding = \
+                  dammit._detectEncoding(data)
+        proposed = [self.fromEncoding, documentEncoding, sniffedEncoding,
+                    "utf-8", "windows-1252"]
+        for bom, encoding in (('\x00\x00\xfe\xff', 'utf-32be'),
+                              ('\xff\xfe\x00\x00', 'utf-32le'),
+                              ('\xfe\xff', 'utf-16be'),
+                              ('\xff\xfe', 'utf-16le'),
+                              ('\xef\xbb\xbf', 'utf-8')):
+            if data.startswith(bom):
+                data = data[len(bom):]
+                proposed = [encoding]
+                break
+        for encoding in proposed:
+            encoding = dammit.find_codec(encoding)
+            if encoding == 'ascii':
+                # Any document starting with '<' is sniffed as ascii.
+                # UnicodeDammit can try utf-8 next once it finds that
+                # the whole thing isn't, but we only have the start of
+                # it, so decode it as utf-8 and call it ascii until it
+                # turns out not to be.
+                if self._setDecoder('utf-8', data):
+                    self.originalEncoding = 'ascii'
+                    return data
+            elif encoding and self._setDecoder(encoding, data):
+                return data
+        self._setDecoder('windows-1252', data)
+        return data
+
+    def _setDecoder(self, encoding, data):
+        """Starts decoding the document from encoding, if the start of
+        it, data, can be decoded from it. Returns whether it could."""
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            decoder.decode(data, False)
+        except (LookupError, UnicodeDecodeError):
+            return False
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self.originalEncoding = encoding
+        return True
+
+    def _feedText(self, text):
+        if self._tokenizer:
+            self._tokenizer.feed(text)
+            return
+        if self.markupMassage:
+            text = self._unmassaged + text
+            end = len(text)
+            if not self._complete:
+                end = text.rfind('>') + 1
+            text, self._unmassaged = text[:end], text[end:]
+            for fix, m in self._massageFixes(text):
+                text = fix.sub(m, text)
+        SGMLParser.feed(self, text)
+
+    def _notWellFormed(self, markup):
+        """Called by the tokenizer when it can't tokenize markup, all
+        of the document it's been fed so far. Starts the tree again,
+        with SGMLParser tokenizing from here on."""
+        self._tokenizer = None
+        self.reset()
+        self._feedText(markup)
+
     def __getattr__(self, methodName):
         """This method routes method call requests to either the SGMLParser
         superclass or the Tag superclass, depending on the method name."""
@@ -1147,15 +1461,19 @@ class BeautifulStoneSoup(Tag, SGMLParser):
 
     def pushTag(self, tag):
         #print "Push", tag.name
-        if self.currentTag:
+        if self.currentTag is not None:
             self.currentTag.contents.append(tag)
+            PageElement._treeGeneration += 1
         self.tagStack.append(tag)
         self.currentTag = self.tagStack[-1]
 
     def endData(self, containerClass=NavigableString):
         if self.currentData:
             currentData = ''.join(self.currentData)
-            if not currentData.translate(self.STRIP_ASCII_SPACES):
+            # Whether it's all ASCII spaces, like translating it with
+            # STRIP_ASCII_SPACES would tell us, but without going through
+            # all of it when it's not.
+            if not currentData.strip(self.ASCII_SPACES):
                 if '\n' in currentData:
                     currentData = '\n'
                 else:
@@ -1167,10 +1485,11 @@ class BeautifulStoneSoup(Tag, SGMLParser):
                 return
             o = containerClass(currentData)
             o.setup(self.currentTag, self.previous)
-            if self.previous:
+            if self.previous is not None:
                 self.previous.next = o
             self.previous = o
             self.currentTag.contents.append(o)
+            PageElement._treeGeneration += 1
 
 
     def _popToTag(self, name, inclusivePop=True):
@@ -1184,10 +1503,14 @@ class BeautifulStoneSoup(Tag, SGMLParser):
 
         numPops = 0
         mostRecentTag = None
-        for i in range(len(self.tagStack)-1, 0, -1):
-            if name == self.tagStack[i].name:
-                numPops = len(self.tagStack)-i
-                break
+        if self.tagStack[-1].name == name and len(self.tagStack) > 1:
+            # The usual case, of closing the tag we're in.
+            numPops = 1
+        else:
+            for i in range(len(self.tagStack)-1, 0, -1):
+                if name == self.tagStack[i].name:
+                    numPops = len(self.tagStack)-i
+                    break
         if not inclusivePop:
             numPops = numPops - 1
 
@@ -1216,6 +1539,14 @@ class BeautifulStoneSoup(Tag, SGMLParser):
         nestingResetTriggers = self.NESTABLE_TAGS.get(name)
         isNestable = nestingResetTriggers != None
         isResetNesting = self.RESET_NESTING_TAGS.has_key(name)
+        if not isNestable and not isResetNesting:
+            # Then all there is to do is pop to the previous tag of this
+            # type, if there is one.
+            for i in range(len(self.tagStack)-1, 0, -1):
+                if self.tagStack[i].name == name:
+                    self._popToTag(name)
+                    break
+            return
         popTo = None
         inclusive = True
         for i in range(len(self.tagStack)-1, 0, -1):
@@ -1251,7 +1582,8 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             return
         self.endData()
 
-        if not self.isSelfClosingTag(name) and not selfClosing:
+        isSelfClosingTag = self.isSelfClosingTag(name)
+        if not isSelfClosingTag and not selfClosing:
             self._smartPop(name)
 
         if self.parseOnlyThese and len(self.tagStack) <= 1 \
@@ -1259,11 +1591,11 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             return
 
         tag = Tag(self, name, attrs, self.currentTag, self.previous)
-        if self.previous:
+        if self.previous is not None:
             self.previous.next = tag
         self.previous = tag
         self.pushTag(tag)
-        if selfClosing or self.isSelfClosingTag(name):
+        if selfClosing or isSelfClosingTag:
             self.popTag()
         if name in self.QUOTE_TAGS:
             #print "Beginning quote (%s)" % name
@@ -1368,6 +1700,8 @@ class BeautifulStoneSoup(Tag, SGMLParser):
         if self.rawdata[i:i+9] == '<![CDATA[':
              k = self.rawdata.find(']]>', i)
              if k == -1:
+                 if not self._complete:
+                     return -1
                  k = len(self.rawdata)
              data = self.rawdata[i+9:k]
              j = k+3
@@ -1376,6 +1710,10 @@ class BeautifulStoneSoup(Tag, SGMLParser):
             try:
                 j = SGMLParser.parse_declaration(self, i)
             except SGMLParseError:
+                if not self._complete:
+                    # It might be an error because the rest of it
+                    # hasn't arrived yet.
+                    return -1
                 toHandle = self.rawdata[i:]
                 self.handle_data(toHandle)
                 j = i + len(toHandle)
@@ -1506,10 +1844,12 @@ class BeautifulSoup(BeautifulStoneSoup):
             match = self.CHARSET_RE.search(contentType)
             if match:
                 if getattr(self, 'declaredHTMLEncoding') or \
-                       (self.originalEncoding == self.fromEncoding):
+                       (self.originalEncoding == self.fromEncoding) or \
+                       self.markup is None:
                     # This is our second pass through the document, or
                     # else an encoding was specified explicitly and it
-                    # worked. Rewrite the meta tag.
+                    # worked, or the document is being fed to us and
+                    # we can't go back through it. Rewrite the meta tag.
                     newAttr = self.CHARSET_RE.sub\
                               (lambda(match):match.group(1) +
                                "%SOUP-ENCODING%", value)
@@ -1611,6 +1951,174 @@ class BeautifulSOAP(BeautifulStoneSoup):
                 parent[tag.name] = tag.contents[0]
         BeautifulStoneSoup.popTag(self)
 
+class ExpatTokenizer:
+    """A tokenizer for BeautifulStoneSoup which uses expat instead of
+    SGMLParser. expat is written in C, so this leaves building the
+    tree as most of the work of parsing well-formed XML, and the tree
+    it builds is the same.
+
+    Where expat reports something differently than SGMLParser, the
+    markup is checked to see what SGMLParser would have made of it:
+    entity and character references are passed on as references, and
+    an empty-element tag is just a start tag. The only difference left
+    is that expat turns line breaks and tabs in attribute values into
+    spaces.
+
+    A document which turns out not to be well-formed is parsed again
+    from the start with SGMLParser. So is one with an internal DTD
+    subset, since expat would replace the entities declared in it, and
+    one with any of the soup's QUOTE_TAGS in it."""
+
+    def __init__(self, soup):
+        self.soup = soup
+        # All the UTF-8 fed to expat, in case SGMLParser has to start
+        # again, and the part of it expat hasn't finished with, which
+        # starts rawStart bytes into the document.
+        self.fed = []
+        self.raw = ''
+        self.rawStart = 0
+        # How many elements we're inside.
+        self.depth = 0
+        self.inCData = False
+        # Whether the last token was a start tag.
+        self.justStarted = False
+        # The soup's start_<name> methods, by name, or None.
+        self.startMethods = {}
+
+        parser = xml.parsers.expat.ParserCreate('utf-8')
+        parser.ordered_attributes = True
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characterData
+        parser.CommentHandler = self.comment
+        parser.ProcessingInstructionHandler = self.processingInstruction
+        parser.XmlDeclHandler = self.xmlDecl
+        parser.StartDoctypeDeclHandler = self.startDoctypeDecl
+        parser.StartCdataSectionHandler = self.startCData
+        parser.EndCdataSectionHandler = self.endCData
+        parser.DefaultHandlerExpand = self.default
+        self.parser = parser
+
+    def feed(self, text, final=False):
+        data = text.encode('utf-8')
+        self.fed.append(data)
+        self.raw = self.raw + data
+        try:
+            self.parser.Parse(data, final)
+        except xml.parsers.expat.ExpatError:
+            markup = ''.join(self.fed).decode('utf-8')
+            self.fed = self.raw = None
+            self.soup._notWellFormed(markup)
+            return
+        # Between calls to Parse, expat gives the position just past the
+        # last token it reported, so that's where any token it's still
+        # waiting for the rest of starts.
+        done = self.parser.CurrentByteIndex - self.rawStart
+        if done > 0:
+            self.raw = self.raw[done:]
+            self.rawStart += done
+
+    def close(self):
+        self.feed(u'', True)
+
+    def _index(self):
+        """Returns where in self.raw the current token starts."""
+        return self.parser.CurrentByteIndex - self.rawStart
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        name = name.lower()
+        if name in self.soup.QUOTE_TAGS:
+            # Its contents have to be passed on just as they are in the
+            # markup, which expat can't do.
+            raise xml.parsers.expat.ExpatError('<%s> tag' % name)
+        if attrs:
+            attrs = [(attrs[i].lower(), attrs[i+1])
+                     for i in range(0, len(attrs), 2)]
+        # SGMLParser lets a start_<name> method handle <name> tags.
+        method = self.startMethods.get(name, 0)
+        if method == 0:
+            method = getattr(self.soup, 'start_' + name, None)
+            self.startMethods[name] = method
+        if method:
+            method(attrs)
+        else:
+            self.soup.unknown_starttag(name, attrs)
+        self.justStarted = True
+
+    def endElement(self, name):
+        self.depth -= 1
+        if self.justStarted:
+            self.justStarted = False
+            i = self._index()
+            if self.raw[i-2:i] == '/>':
+                # This is the end of an empty-element tag, which
+                # SGMLParser doesn't know about.
+                return
+        self.soup.unknown_endtag(name.lower())
+
+    def characterData(self, data):
+        self.justStarted = False
+        # expat reports each reference as the character it stands for,
+        # and each line break as '\n', on their own.
+        if len(data) < 3:
+            i = self._index()
+            if data == '\n' and self.raw[i] == '\r':
+                data = self.raw[i:i+2] == '\r\n' and u'\r\n' or u'\r'
+            elif self.raw[i] == '&' and not self.inCData:
+                ref = self.raw[i+1:self.raw.index(';', i)].decode('utf-8')
+                if ref[0] != '#':
+                    self.soup.handle_entityref(ref)
+                elif ref[1:].isdigit():
+                    self.soup.handle_charref(ref[1:])
+                else:
+                    # SGMLParser doesn't know about hex references.
+                    self.soup.handle_data('&' + ref + ';')
+                return
+        self.soup.handle_data(data)
+
+    def comment(self, data):
+        self.justStarted = False
+        self.soup.handle_comment(data)
+
+    def processingInstruction(self, target, data):
+        self.justStarted = False
+        i = self._index()
+        self.soup.handle_pi(
+            self.raw[i+2:self.raw.index('?>', i)+1].decode('utf-8'))
+
+    def xmlDecl(self, version, encoding, standalone):
+        self.processingInstruction('xml', None)
+
+    def startDoctypeDecl(self, name, systemId, publicId, internalSubset):
+        if internalSubset:
+            raise xml.parsers.expat.ExpatError('internal DTD subset')
+        decl = 'DOCTYPE ' + name
+        if publicId:
+            decl += ' PUBLIC "%s"' % publicId
+            if systemId:
+                decl += ' "%s"' % systemId
+        elif systemId:
+            decl += ' SYSTEM "%s"' % systemId
+        self.soup.handle_decl(decl)
+
+    def startCData(self):
+        self.justStarted = False
+        self.inCData = True
+        self.soup.endData()
+        # An empty CDATA section is still a string.
+        self.soup.handle_data(u'')
+
+    def endCData(self):
+        self.inCData = False
+        self.soup.endData(CData)
+
+    def default(self, data):
+        # The only text expat doesn't report as character data is the
+        # whitespace outside the document element.
+        if self.depth == 0 and data.isspace():
+            self.soup.handle_data(data)
+
 #Enterprise class names! It has come to our attention that some people
 #think the names of the Beautiful Soup parser classes are too silly
 #and "unprofessional" for use in enterprise screen-scraping. We feel
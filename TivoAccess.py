@@ -3,19 +3,75 @@
 #
 # Library to remotely access Tivo DVRs.
 #
+# Importing this should be quick, so that small scripts which only want
+# LoadMak or a single Download start right away.  The heavier modules, for
+# discovery (avahi pulls in glib and dbus), the BeautifulSoup fallback parser,
+# http and thread pools, are imported where they're first used instead.
+#
 
+import json
 import os
-import urllib2
+import Queue
+import re
+import sys
+import threading
+import time
+import traceback
+import urlparse
 import Cookie
-import BeautifulSoup
-import html_unescape
+import tivo_container
+
+
+# The module we find tivos with, once _FindHosts has loaded it.
+find_hosts = None
+has_avahi = None
+
+
+def _FindHosts():
+  """Returns the module to find tivos with: avahi_find_hosts if avahi is
+  installed, otherwise our own mdns browser."""
+  global find_hosts, has_avahi
+  if find_hosts is None:
+    try:
+      import avahi_find_hosts as module
+      has_avahi = 1
+    except ImportError:
+      import mdns_find_hosts as module
+      has_avahi = 0
+    find_hosts = module
+  return find_hosts
+
+
+# The NowPlaying query, for tivos which don't advertise one.
+NOW_PLAYING_PATH = '/TiVoConnect?Command=QueryContainer&Container=%2FNowPlaying'
+
+# Downloads smaller than this are assumed to have failed.
+MIN_DOWNLOAD_SIZE = 100*1024*1024
+# How much of a video to read from the tivo at a time.
+DOWNLOAD_BLOCK_SIZE = 1024*1024
+# When resuming a download, how much of the end of the partial file to fetch
+# again to check that the tivo is sending the same thing.
+RESUME_OVERLAP = 64*1024
+
+# Between downloads from the same tivo, the DownloadScheduler waits this many
+# times the tivo's recent time to first byte, within these limits, to let the
+# tivo recover.
+DOWNLOAD_PAUSE_FACTOR = 5
+MIN_DOWNLOAD_PAUSE = 1.0
+MAX_DOWNLOAD_PAUSE = 60.0
 
+# Limits for the NowPlaying ItemCount when adapting the page size.  Older
+# units get very slow on large pages, and none return more than 128 items.
+MIN_PAGE_SIZE = 16
+MAX_PAGE_SIZE = 128
+# Starting page size for the adaptive mode, if none is set.
+DEFAULT_PAGE_SIZE = 32
+# The adaptive mode tries to keep each page fetch under this many seconds.
+PAGE_TARGET_SECONDS = 2.0
 
-try:
-  import avahi_find_hosts
-  has_avahi = 1
-except ImportError:
-  has_avahi = 0
+# Where a TivoFetcher given playlist_cache=PLAYLIST_CACHE keeps the last
+# playlist it fetched from each tivo, by TSN.
+PLAYLIST_CACHE = os.path.expanduser('~/.tivo_playlists')
 
 
 class PlayListEntry:
@@ -31,133 +87,930 @@ class PlayListEntry:
     self.url = ''
     self.details_url = ''
     self.inprogress = False
+    self.program_id = ''
 
   def __str__(self):
     return ':'.join([self.title, self.desc, str(self.date), str(self.size), self.channel, self.url])
 
+  def Key(self):
+    """Returns a key for the recording which doesn't depend on which tivo it's
+    on or what we've called the file: the program, station and capture time.
+    """
+    return '%s:%s:%x' % (self.program_id or self.title, self.station,
+                         self.date)
+
+  def ContentId(self):
+    """Returns the tivo's id for the recording, from the id= in its download
+    url, which stays the same when the tivo's address changes.  Falls back
+    to Key() for a url without one."""
+    query = urlparse.parse_qs(urlparse.urlsplit(self.url).query)
+    if query.get('id'):
+      return query['id'][0]
+    return self.Key()
+
+
+class TivoHost:
+  """A tivo on the network, with what it advertises about itself in its
+  tivo-videos TXT record.
+
+  Hosts compare and hash by TSN when it's known, so anything keyed by host
+  still finds the tivo after DHCP gives it a new address.  str() gives the
+  address, so a TivoHost can be used where a host name was before."""
+
+  def __init__(self, address, port=443, protocol='https', path='', tsn='',
+               platform='', swversion='', name=''):
+    self.address = address
+    self.port = port
+    self.protocol = protocol
+    # The path the tivo advertises, usually its NowPlaying query.
+    self.path = path
+    self.tsn = tsn
+    self.platform = platform
+    self.swversion = swversion
+    self.name = name
+
+  def __str__(self):
+    return self.address
+
+  def __repr__(self):
+    return 'TivoHost(%r, tsn=%r)' % (self.address, self.tsn)
+
+  def Key(self):
+    return self.tsn or self.address
+
+  def __eq__(self, other):
+    return isinstance(other, TivoHost) and self.Key() == other.Key()
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.Key())
+
+  def Url(self, path):
+    """Returns the url for path on the tivo, with the advertised protocol and
+    port."""
+    default_port = {'http': 80, 'https': 443}.get(self.protocol)
+    if self.port == default_port:
+      return '%s://%s%s' % (self.protocol, self.address, path)
+    return '%s://%s:%d%s' % (self.protocol, self.address, self.port, path)
+
+
+def _HostFromService(service):
+  """Returns the TivoHost for a resolved tivo-videos service."""
+  txt = {}
+  for item in service.txt:
+    key, sep, value = item.partition('=')
+    if sep:
+      txt[key.lower()] = value
+  return TivoHost(_FindHosts().get_host(service, False), int(service.port),
+                  txt.get('protocol', 'https'), txt.get('path', ''),
+                  txt.get('tsn', ''), txt.get('platform', ''),
+                  txt.get('swversion', ''), service.name)
+
+
+def _Host(host):
+  """Returns host as a TivoHost, if it's just a name or address."""
+  if isinstance(host, TivoHost):
+    return host
+  return TivoHost(host)
+
 
 class TivoFetcher:
-  def __init__(self, tivo_host, media_key):
-    self.tivo_host = tivo_host
+  # Parse NowPlaying pages with the old BeautifulSoup parser instead of
+  # tivo_container.  It's much slower, but will put up with malformed XML.
+  use_soup = False
+
+  def __init__(self, tivo_host, media_key, page_workers=1, page_size=None,
+               adaptive_page_size=False, playlist_cache=None):
+    # A TivoHost, or a host name or address to reach the tivo at on the
+    # standard https port.
+    self.tivo_host = _Host(tivo_host)
     self.media_key = media_key
+    import tivo_http
+    # The digest challenge and nonce count, shared by every thread's opener.
+    self._auth = tivo_http.DigestAuth('tivo', media_key)
+    self.opener = self._BuildOpener()
+
+    # The NowPlaying ItemCount to ask for, or None for the tivo's default.
+    # With adaptive_page_size, this is grown or shrunk between pages based on
+    # how long each item takes to come back, and is kept for the next fetch.
+    self.page_size = page_size
+    self.adaptive_page_size = adaptive_page_size
+    self._best_item_time = None
 
-    # The Tivo uses Digest Auth, with username 'TiVo DVR' and password as the
-    # media access key.  Setup a urllib opener to have that auth information
-    # for both http and https.
-    authinfo = urllib2.HTTPDigestAuthHandler()
-    authinfo.add_password('TiVo DVR', 'http://%s/' % (tivo_host), 'tivo', 
-        media_key)
-    authinfo.add_password('TiVo DVR', 'https://%s/' % (tivo_host), 'tivo',
-        media_key)
-    self.opener = urllib2.build_opener(authinfo)
+    # Number of NowPlaying pages to fetch in parallel once the first page has
+    # told us how many items there are.
+    self.page_workers = page_workers
+
+    # Directory to keep a snapshot of the playlist in, so FetchPlayList can
+    # skip fetching it again when nothing has changed, or None.
+    self.playlist_cache = playlist_cache
+
+    # The transport keeps a connection open between requests, so each thread
+    # using the fetcher gets its own.  They all answer the same digest
+    # challenge, so only the first request to the tivo gets a 401.  The
+    # thread which made the fetcher uses self.opener.
+    self._local = threading.local()
+    self._local.opener = self.opener
+
+    # Whether the tivo honours Range requests for videos, so that partial
+    # downloads can be resumed.  None until we've tried.
+    self.resume_downloads = None
+    # How long the tivo took to start sending the last video we downloaded,
+    # in seconds.
+    self.first_byte_time = None
 
     # The TiVo requires some other cookies for downloading videos.  Those
     # cookies are set when accessing the index, and stored here by
     # ExtractCookies to be used when downloading.
     self.cookies = Cookie.SimpleCookie()
 
-  def Download(self, entry, destfn):
-    # Use curl, since wget and urllib both generate bad data (one webpage
-    # points to a bug in wget's chunked encoding handling)
+  def _BuildOpener(self):
+    # The Tivo uses Digest Auth, with username 'tivo' and password as the
+    # media access key.  The transport keeps the connection to the tivo open
+    # between requests and answers the digest challenge up front, so playlist,
+    # details and downloads should all go through it.
+    import tivo_http
+    return tivo_http.DigestTransport(self._auth)
+
+  def _ThreadOpener(self):
+    """Returns the opener for the current thread."""
+    opener = getattr(self._local, 'opener', None)
+    if opener is None:
+      opener = self._local.opener = self._BuildOpener()
+    return opener
+
+  def _ResumeResponse(self, f, fpo, offset):
+    """Checks whether the response f to a Range request from offset can be
+    used to continue the partial download in fpo.
+
+    The tivo is asked to start a little before the end of what we have, and
+    the overlap has to match what's already on disk.  If it does, fpo is left
+    positioned at its end and True is returned."""
+    if f.status != 206:
+      return False
+    match = re.match(r'bytes (\d+)-', f.msg.getheader('content-range', ''))
+    if not match or int(match.group(1)) != offset:
+      return False
+    fpo.seek(offset)
+    have = fpo.read()
+    got = []
+    left = len(have)
+    while left:
+      buf = f.read(left)
+      if not buf: break
+      got.append(buf)
+      left -= len(buf)
+    return ''.join(got) == have
+
+  def Download(self, entry, destfn, progress=None):
+    """Downloads entry's video to destfn.
+
+    The transfer goes to destfn.dl, which is renamed to destfn once it's
+    complete and looks big enough.  If a destfn.dl is left from an earlier
+    attempt and the tivo honours Range requests, the download carries on from
+    where it stopped.  If given, progress is called after every block as
+    progress(bytes_so_far, bytes_per_second).  Returns True if the download
+    succeeded."""
+    import httplib
     if not entry.url:
       print "Unable to download %s, no url" % (entry.title)
-      return
+      return False
 
     cookie_str = []
     for morsel in self.cookies.values():
       cookie_str.append("%s=%s" % (morsel.key, morsel.value))
-
-    args = []
-    args.append('curl')
-    args.append('--silent')
-    args.append('--cookie')
-    args.append(';'.join(cookie_str))
-    args.append('--digest')
-    args.append('-u')
-    args.append('tivo:%s' % self.media_key)
-    args.append('--output')
-    args.append('%s.dl' % destfn)
-    args.append(entry.url)
-
-    r = os.spawnvp(os.P_WAIT, 'curl', args)
-    if r == 0:
-      file_size = os.path.getsize('%s.dl' % destfn)
-      # Check the size, it should be at least 60% of the size, and pretty big
-      # 60% seems small, but I've seen Robot Chicken episodes as small as 66%
-      # Actually, I've now seen episodes in the 35% range... but I don't know
-      # if I want to make this that lenient.
-      if (file_size < 100*1024*1024) or (file_size < 0.6 * int(entry.size)):
-        print '%s file size too small: %d < %d' % (destfn, file_size,
-            int(entry.size))
-        return
-      os.rename('%s.dl' % destfn, destfn)
-    else:
-      print '%s returned %d' % (' '.join(args), r)
-    return
-
-    # The urllib downloader, which generates a broken file.  I haven't
-    # debugged this yet.
     headers = {}
     headers['Cookie'] = '; '.join(cookie_str)
-    req = urllib2.Request(entry.url, headers=headers)
-    f = self.opener.open(req)
-    fpo = open(destfn, 'w')
-    while 1:
-      buf = f.read(65536)
-      if not buf: break
-      fpo.write(buf)
+
+    partial = '%s.dl' % destfn
+    offset = 0
+    if self.resume_downloads is not False and os.path.exists(partial):
+      offset = max(os.path.getsize(partial) - RESUME_OVERLAP, 0)
+    if offset:
+      headers['Range'] = 'bytes=%d-' % offset
+
+    # httplib takes care of the tivo's chunked encoding for us.  Reading in
+    # big blocks keeps the per-read overhead down on multi-GB transfers.
+    start = time.time()
+    file_size = 0
+    fetched = 0
+    total_size = None
+    try:
+      f = self._ThreadOpener().open(entry.url, headers)
+      # The tivo has answered once the headers are in, which is what the
+      # DownloadScheduler wants to know.  The first block takes a whole
+      # DOWNLOAD_BLOCK_SIZE to arrive.
+      self.first_byte_time = time.time() - start
+      if offset:
+        fpo = open(partial, 'r+b')
+        try:
+          resumed = self._ResumeResponse(f, fpo, offset)
+        except:
+          fpo.close()
+          raise
+        if resumed:
+          self.resume_downloads = True
+          file_size = fpo.tell()
+          match = re.search(r'/(\d+)$', f.msg.getheader('content-range'))
+          if match:
+            total_size = int(match.group(1))
+          print 'Resuming %s at %d bytes' % (destfn, file_size)
+        elif f.status == 206:
+          # The tivo did the Range, but what we have on disk doesn't match
+          # it.  Drop the connection, since the rest of the response is still
+          # coming, and start again from scratch.
+          fpo.close()
+          self._ThreadOpener().close()
+          os.remove(partial)
+          print '%s does not match the tivo, starting over' % partial
+          return self.Download(entry, destfn, progress)
+        else:
+          # The tivo ignored the Range and is sending the whole thing.
+          self.resume_downloads = False
+          fpo.seek(0)
+          fpo.truncate()
+      else:
+        fpo = open(partial, 'wb')
+      try:
+        while 1:
+          buf = f.read(DOWNLOAD_BLOCK_SIZE)
+          if not buf: break
+          fpo.write(buf)
+          file_size += len(buf)
+          fetched += len(buf)
+          if progress:
+            progress(file_size, fetched / max(time.time() - start, 0.001))
+      finally:
+        fpo.close()
+    except (IOError, httplib.HTTPException), reason:
+      print '%s failed after %d bytes: %s' % (entry.url, file_size, reason)
+      return False
+
+    if total_size is not None and file_size != total_size:
+      print '%s resumed size wrong: %d != %d' % (destfn, file_size, total_size)
+      return False
+
+    # Check the size, it should be at least 60% of the size, and pretty big
+    # 60% seems small, but I've seen Robot Chicken episodes as small as 66%
+    # Actually, I've now seen episodes in the 35% range... but I don't know
+    # if I want to make this that lenient.
+    if (file_size < MIN_DOWNLOAD_SIZE) or (file_size < 0.6 * int(entry.size)):
+      print '%s file size too small: %d < %d' % (destfn, file_size,
+          int(entry.size))
+      return False
+    os.rename('%s.dl' % destfn, destfn)
+    return True
 
   def ExtractCookies(self, headers):
     if headers.has_key("set-cookie"):
       for value in headers.getheaders("set-cookie"):
         self.cookies.load(value)
 
-  def FetchPlayList(self):
+  def FetchDetails(self, entry):
+    """Fetches the TiVoVideoDetails for entry.
+
+    Returns a dict of the text of each element in the details document, by
+    path, ie 'showing/program/title'.  Where an element repeats, the first
+    one is used."""
+    f = self._ThreadOpener().open(entry.details_url)
+    self.ExtractCookies(f.headers)
+    return tivo_container.ParseDocument(f)
+
+  def _NowPlayingUrl(self, offset, page_size=None, sort_order=None):
     # /TiVoConnect?Command=QueryContainer&Container=%2FNowPlaying&Recurse=Yes&AnchorOffset=0
+    path = self.tivo_host.path
+    if 'Command=QueryContainer' not in path:
+      path = NOW_PLAYING_PATH
+    url = self.tivo_host.Url("%s&Recurse=Yes&AnchorOffset=%d" % (path, offset))
+    if page_size:
+      url += "&ItemCount=%d" % page_size
+    if sort_order:
+      url += "&SortOrder=%s" % sort_order
+    return url
+
+  def _FetchPage(self, offset, page_size=None, sort_order=None):
+    """Fetches and parses one NowPlaying page starting at offset.
+
+    Returns a tuple of (totalitems, list of PlayListEntry)."""
+    f = self._ThreadOpener().open(self._NowPlayingUrl(offset, page_size,
+                                                      sort_order))
+    self.ExtractCookies(f.headers)
+    if self.use_soup:
+      return self._ParseSoupPage(f)
+    return self._ParsePage(f)
+
+  def _ParsePage(self, f):
+    """Parses a NowPlaying page from the file object f.
+
+    Returns a tuple of (totalitems, list of PlayListEntry)."""
+    parser = tivo_container.ContainerParser()
+    entries = [self._EntryFromItem(item) for item in parser.ParseFile(f)]
+    return parser.TotalItems(), entries
+
+  def _EntryFromItem(self, item):
+    # expat has already decoded the entities, so unlike the soup version
+    # there's no need to unescape anything here.
+    entry = PlayListEntry()
+    entry.title = item['Details/Title']
+    entry.episode = item.get('Details/EpisodeTitle', '')
+    if 'Details/Description' in item:
+      entry.desc = item['Details/Description'].replace('Copyright Tribune Media Services, Inc.', '').strip()
+    entry.date = int(item['Details/CaptureDate'], 0)
+    entry.size = item['Details/SourceSize']
+    if 'Details/SourceChannel' in item:
+      entry.channel = item['Details/SourceChannel']
+      entry.station = item.get('Details/SourceStation', '')
+    if 'Details/InProgress' in item:
+      entry.inprogress = True
+    # urllib2's http auth support doesn't like :80
+    entry.url = item['Links/Content/Url'].replace(':80/', '/')
+    if 'Details/CopyProtected' in item:
+      entry.copyprotected = True
+    entry.program_id = item.get('Details/ProgramId', '')
+    entry.details_url = item['Links/TiVoVideoDetails/Url']
+    return entry
+
+  def _ParseSoupPage(self, f):
+    import BeautifulSoup
+    soup = BeautifulSoup.BeautifulStoneSoup(
+        trustedXML=True, tokenizer=BeautifulSoup.ExpatTokenizer)
+    while 1:
+      data = f.read(tivo_container.READ_SIZE)
+      if not data:
+        break
+      soup.feed(data)
+    soup.close()
+    totalcount = int(soup.tivocontainer.details.totalitems.string)
+    # The Items are all children of the TiVoContainer, so there's no need to
+    # search the whole tree for them.
+    items = soup.tivocontainer.findAll('item', recursive=False)
+    return totalcount, [self._ParseSoupItem(item) for item in items]
+
+  def _ParseSoupItem(self, item):
+    import html_unescape
+    entry = PlayListEntry()
+    entry.title = html_unescape.unescape(item.details.title.string)
+    if item.details.episodetitle:
+      entry.episode = html_unescape.unescape(item.details.episodetitle.string)
+    if item.details.description:
+      entry.desc = html_unescape.unescape(item.details.description.string).replace('Copyright Tribune Media Services, Inc.', '').strip()
+    entry.date = int(item.details.capturedate.string, 0)
+    entry.size = item.details.sourcesize.string
+    if item.details.sourcechannel:
+      entry.channel = item.details.sourcechannel.string
+      entry.station = item.details.sourcestation.string
+    if item.details.inprogress:
+      entry.inprogress = True
+    entry.url = html_unescape.unescape(item.links.content.url.string)
+    # urllib2's http auth support doesn't like :80
+    entry.url = entry.url.replace(':80/', '/')
+    if item.details.copyprotected:
+      entry.copyprotected = True
+    if item.details.programid:
+      entry.program_id = item.details.programid.string
+    entry.details_url = html_unescape.unescape(item.links.tivovideodetails.url.string)
+    return entry
+
+  def _AdaptPageSize(self, page_size, elapsed, nitems, last=False):
+    """Returns the page size to use after a page of nitems took elapsed
+    seconds.
+
+    Grows the page while pages come back quickly, and shrinks it when a page
+    runs over PAGE_TARGET_SECONDS or the time per item gets much worse than
+    the best we've seen, which is what oversized pages on older units do.
+    The new size is based on nitems, since the tivo may cap a page below what
+    we asked for.  The last page of the list is usually short, and mostly the
+    fixed cost of a request, so it leaves the size alone."""
+    if not nitems or last:
+      return page_size
+    page_size = nitems
+    item_time = elapsed / nitems
+    if self._best_item_time is None or item_time < self._best_item_time:
+      self._best_item_time = item_time
+    if elapsed > PAGE_TARGET_SECONDS or item_time > 2 * self._best_item_time:
+      page_size = page_size / 2
+    elif elapsed < PAGE_TARGET_SECONDS / 2:
+      page_size = page_size * 2
+    return max(MIN_PAGE_SIZE, min(MAX_PAGE_SIZE, page_size))
+
+  def _IterPagesConcurrently(self, offsets, workers, page_size):
+    """Fetches the pages at offsets with a pool of worker threads, and yields
+    each page's entries in offset order."""
+    def fetch(offset):
+      return self._FetchPage(offset, page_size)[1]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(offsets)))
+    try:
+      for entries in pool.imap(fetch, offsets):
+        yield entries
+    finally:
+      pool.terminate()
+
+  def IterPlayList(self, workers=None):
+    """Yields PlayListEntry objects as each NowPlaying page is parsed.
+
+    With a single worker, only the page currently being walked is held in
+    memory, so callers can start working on the first entries while later
+    pages are still to be fetched.  With more workers, the remaining pages
+    are fetched in parallel once the first page gives us TotalItems, and
+    merged back in order.  Entries which shift between pages while we're
+    fetching are only returned once."""
+    if workers is None:
+      workers = self.page_workers
+    page_size = self.page_size
+    if self.adaptive_page_size and not page_size:
+      page_size = DEFAULT_PAGE_SIZE
+    seen = set()
     offset = 0
     totalcount = 0
-    results = []
+    count = 0
     while 1:
-      url = "https://%s/TiVoConnect?Command=QueryContainer&Container=%%2FNowPlaying&Recurse=Yes&AnchorOffset=%d" % (self.tivo_host, offset)
-      f = self.opener.open(url)
-      self.ExtractCookies(f.headers)
-      soup = BeautifulSoup.BeautifulStoneSoup(f.read())
+      start = time.time()
+      pagetotal, entries = self._FetchPage(offset, page_size=page_size)
       if totalcount == 0:
-        totalcount = int(soup.tivocontainer.details.totalitems.string)
-      for item in soup.tivocontainer.findAll('item'):
-        entry = PlayListEntry()
-        entry.title = html_unescape.unescape(item.details.title.string)
-        if item.details.episodetitle:
-          entry.episode = html_unescape.unescape(item.details.episodetitle.string)
-        if item.details.description:
-          entry.desc = html_unescape.unescape(item.details.description.string).replace('Copyright Tribune Media Services, Inc.', '').strip()
-        entry.date = int(item.details.capturedate.string, 0)
-        entry.size = item.details.sourcesize.string
-        if item.details.sourcechannel:
-          entry.channel = item.details.sourcechannel.string
-          entry.station = item.details.sourcestation.string
-        if item.details.inprogress:
-          entry.inprogress = True
-        entry.url = html_unescape.unescape(item.links.content.url.string)
-        # urllib2's http auth support doesn't like :80
-        entry.url = entry.url.replace(':80/', '/')
-        if item.details.copyprotected:
-          entry.copyprotected = True
-        entry.details_url = html_unescape.unescape(item.links.tivovideodetails.url.string)
-        results.append(entry)
-      if len(results) < totalcount and offset < len(results):
-        offset = len(results) + 1
+        totalcount = pagetotal
+      count += len(entries)
+      if self.adaptive_page_size:
+        page_size = self._AdaptPageSize(page_size, time.time() - start,
+                                        len(entries), count >= totalcount)
+        self.page_size = page_size
+      for entry in entries:
+        if entry.url not in seen:
+          seen.add(entry.url)
+          yield entry
+      # AnchorOffset is the 0-based index of the first item on the page.
+      if count < totalcount and offset < count:
+        offset = count
       else:
         break
+      if workers > 1:
+        # The tivo may cap the page below what we asked for, so use the
+        # size of the first page for the remaining offsets.
+        page_size = len(entries)
+        offsets = range(offset, totalcount, page_size)
+        for entries in self._IterPagesConcurrently(offsets, workers,
+                                                   page_size):
+          for entry in entries:
+            if entry.url not in seen:
+              seen.add(entry.url)
+              yield entry
+        break
+
+  def _FetchChangeState(self):
+    """Fetches a single item NowPlaying page, and returns the TotalItems and
+    LastChangeDate from it, which change whenever a recording is added or
+    deleted."""
+    f = self._ThreadOpener().open(self._NowPlayingUrl(0, 1))
+    self.ExtractCookies(f.headers)
+    parser = tivo_container.ContainerParser()
+    for item in parser.ParseFile(f):
+      pass
+    return parser.TotalItems(), parser.container.get('Details/LastChangeDate')
+
+  def _SnapshotFilename(self):
+    return os.path.join(self.playlist_cache,
+                        '%s.json' % self.tivo_host.Key())
+
+  def _SnapshotUrl(self, url):
+    """Returns url, from a snapshot, pointing at the tivo's address now.  The
+    snapshot is kept by TSN, so the tivo may have been somewhere else when it
+    was taken.  The scheme and port are left alone, since the download and
+    details urls differ in those."""
+    parts = urlparse.urlsplit(url)
+    if not parts.hostname or parts.hostname == self.tivo_host.address:
+      return url
+    netloc = self.tivo_host.address
+    if parts.port:
+      netloc = '%s:%d' % (netloc, parts.port)
+    return urlparse.urlunsplit((parts.scheme, netloc) + parts[2:])
+
+  def _ReadSnapshot(self):
+    """Returns (total items, last change date, entries) from the playlist
+    snapshot, or None if there isn't a usable one."""
+    try:
+      snapshot = json.load(open(self._SnapshotFilename()))
+      entries = []
+      for record in snapshot['entries']:
+        entry = PlayListEntry()
+        for key, value in record.items():
+          setattr(entry, str(key), value)
+        entry.url = self._SnapshotUrl(entry.url)
+        entry.details_url = self._SnapshotUrl(entry.details_url)
+        entries.append(entry)
+      return snapshot['total'], snapshot['last_change'], entries
+    except (IOError, ValueError, KeyError, TypeError, AttributeError):
+      return None
+
+  def _WriteSnapshot(self, total, last_change, entries):
+    if not os.path.isdir(self.playlist_cache):
+      os.makedirs(self.playlist_cache)
+    # Write and rename, so a reader never sees half a snapshot.
+    filename = self._SnapshotFilename()
+    tmpfn = '%s.%d' % (filename, os.getpid())
+    fp = open(tmpfn, 'w')
+    json.dump({'total': total, 'last_change': last_change,
+               'entries': [vars(entry) for entry in entries]}, fp)
+    fp.close()
+    os.rename(tmpfn, filename)
+
+  def _IterPagesByDate(self):
+    """Yields the entries on each NowPlaying page, newest recordings first,
+    with the TotalItems reported with them and whether the page reaches the
+    end of the list."""
+    offset = 0
+    while 1:
+      total, entries = self._FetchPage(offset, self.page_size,
+                                       sort_order='!CaptureDate')
+      if not entries:
+        break
+      offset += len(entries)
+      yield total, entries, offset >= total
+      if offset >= total:
+        break
+
+  def _FetchDelta(self, known_entries):
+    """Fetches what has changed on the tivo since known_entries.
+
+    Pages are fetched newest first until they reach a finished recording we
+    already know about, and every known recording newer than the last one
+    fetched which hasn't turned up has been counted as deleted.  Known
+    recordings older than that are only counted as deleted once the last
+    page has been fetched without them.  Returns (entries, added, removed).
+    """
+    known = dict([(entry.ContentId(), entry) for entry in known_entries])
+    # Known recordings which haven't turned up yet.
+    unseen = dict(known)
+    # Known recordings which did turn up, as the tivo has them now.
+    fresh = {}
+    added = []
+    added_ids = set()
+    reached_known = False
+    removed_ids = set()
+    for total, entries, at_end in self._IterPagesByDate():
+      for entry in entries:
+        content_id = entry.ContentId()
+        if content_id in known:
+          old = unseen.pop(content_id, None)
+          if old is None:
+            continue
+          fresh[content_id] = entry
+          # An in progress recording may have changed, so keep looking past
+          # it.
+          if not old.inprogress:
+            reached_known = True
+        elif content_id not in added_ids:
+          added_ids.add(content_id)
+          added.append(entry)
+      if at_end:
+        # We've been through the whole list, so anything we haven't seen has
+        # gone.
+        removed_ids = set(unseen)
+        break
+      oldest = entries[-1].date
+      removed_ids = set([content_id for content_id, entry in unseen.items()
+                         if entry.date > oldest])
+      if (reached_known and
+          len(removed_ids) >= len(known) + len(added) - total):
+        break
+
+    removed = [entry for entry in known_entries
+               if entry.ContentId() in removed_ids]
+    entries = added + [fresh.get(entry.ContentId(), entry)
+                       for entry in known_entries
+                       if entry.ContentId() not in removed_ids]
+    return entries, added, removed
+
+  def SyncPlayList(self, workers=None):
+    """Brings the playlist snapshot in playlist_cache up to date with the
+    tivo.  Returns (entries, added, removed): the whole playlist, and the
+    lists of PlayListEntry recorded and deleted since the snapshot was taken.
+
+    A single item page is fetched first, and if the tivo's TotalItems and
+    LastChangeDate match the snapshot's, nothing else is.  A recording
+    finishing doesn't change either, so a snapshot with a recording in
+    progress is always brought up to date.  Otherwise, only the newest pages
+    are fetched, back as far as the snapshot, which is a page or two when a
+    few shows have been recorded since.  Finding a deleted recording means
+    going back as far as it, though.  Without a snapshot, everything is
+    fetched and added."""
+    if not self.playlist_cache:
+      entries = list(self.IterPlayList(workers))
+      return entries, entries, []
+    total, last_change = self._FetchChangeState()
+    snapshot = self._ReadSnapshot()
+    if snapshot is None or not last_change:
+      entries = list(self.IterPlayList(workers))
+      added, removed = entries, []
+    else:
+      entries = snapshot[2]
+      if snapshot[:2] == (total, last_change) and not [
+          entry for entry in entries if entry.inprogress]:
+        return entries, [], []
+      entries, added, removed = self._FetchDelta(entries)
+    try:
+      self._WriteSnapshot(total, last_change, entries)
+    except (IOError, OSError):
+      pass
+    return entries, added, removed
+
+  def FetchPlayList(self, workers=None):
+    """Returns the list of PlayListEntry on the tivo.  With a
+    playlist_cache, only what has changed since the last call is fetched; see
+    SyncPlayList."""
+    if not self.playlist_cache:
+      return list(self.IterPlayList(workers))
+    return self.SyncPlayList(workers)[0]
+
+
+class TivoPool:
+  """Runs TivoFetcher calls against many tivos at once from one process.
+
+  Each tivo gets its own small pool of worker threads, so slow tivos don't
+  hold up the others, and no tivo has more than per_host requests running
+  against it at a time.  The calls return multiprocessing AsyncResult
+  objects; use get() on them to wait for the TivoFetcher's return value.
+  Any extra keyword arguments are passed on to each TivoFetcher."""
+
+  def __init__(self, media_key, per_host=1, **fetcher_args):
+    self.media_key = media_key
+    self.per_host = per_host
+    self.fetcher_args = fetcher_args
+    self.fetchers = {}
+    self._pools = {}
+
+  def Fetcher(self, host):
+    from multiprocessing.pool import ThreadPool
+    host = _Host(host)
+    if host not in self.fetchers:
+      self.fetchers[host] = TivoFetcher(host, self.media_key,
+                                        **self.fetcher_args)
+      self._pools[host] = ThreadPool(self.per_host)
+    fetcher = self.fetchers[host]
+    # The same tivo may have come back with a new address from DHCP.  Keep
+    # the fetcher and what it has learned about the tivo, but send it to the
+    # new address.
+    old = fetcher.tivo_host
+    if (host.address, host.port, host.protocol) != (old.address, old.port,
+                                                    old.protocol):
+      fetcher.tivo_host = host
+    return fetcher
+
+  def _Run(self, host, method, *args):
+    fetcher = self.Fetcher(host)
+    return self._pools[host].apply_async(getattr(fetcher, method), args)
+
+  def FetchPlayList(self, host):
+    return self._Run(host, 'FetchPlayList')
+
+  def FetchDetails(self, host, entry):
+    return self._Run(host, 'FetchDetails', entry)
+
+  def Download(self, host, entry, destfn):
+    return self._Run(host, 'Download', entry, destfn)
+
+  def Close(self):
+    """Waits for all outstanding calls to finish."""
+    for pool in self._pools.values():
+      pool.close()
+    for pool in self._pools.values():
+      pool.join()
+
+
+class DownloadScheduler:
+  """Downloads from many tivos at once, one transfer per tivo at a time.
+
+  Each tivo gets its own queue and worker thread.  Instead of a fixed sleep
+  between downloads, the worker pauses for DOWNLOAD_PAUSE_FACTOR times a
+  running average of how long the tivo has been taking to start sending,
+  so a struggling tivo gets more time to recover and an idle one hardly
+  waits at all."""
+
+  def __init__(self, pause_factor=DOWNLOAD_PAUSE_FACTOR,
+               min_pause=MIN_DOWNLOAD_PAUSE, max_pause=MAX_DOWNLOAD_PAUSE):
+    self.pause_factor = pause_factor
+    self.min_pause = min_pause
+    self.max_pause = max_pause
+    self._queues = {}
+    self._threads = {}
+    # Keys of the entries queued or being downloaded.
+    self._pending = set()
+    self._lock = threading.Lock()
+    # host -> running average of the time to first byte
+    self.first_byte_times = {}
+
+  def Pause(self, host):
+    """Returns how long to wait before the next download from host."""
+    first_byte_time = self.first_byte_times.get(host)
+    if first_byte_time is None:
+      return self.min_pause
+    return max(self.min_pause, min(self.max_pause,
+                                   self.pause_factor * first_byte_time))
+
+  def _RecordFirstByteTime(self, host, first_byte_time):
+    if first_byte_time is None:
+      return
+    average = self.first_byte_times.get(host)
+    if average is None:
+      self.first_byte_times[host] = first_byte_time
+    else:
+      self.first_byte_times[host] = 0.7 * average + 0.3 * first_byte_time
+
+  def _Worker(self, host, queue):
+    first = True
+    while 1:
+      job = queue.get()
+      if job is None:
+        break
+      fetcher, entry, destfn, callback = job
+      if not first:
+        time.sleep(self.Pause(host))
+      first = False
+      fetcher.first_byte_time = None
+      # Whatever goes wrong with one download, the worker has to carry on
+      # with the rest of the tivo's queue.
+      try:
+        ok = fetcher.Download(entry, destfn)
+      except Exception:
+        print 'Downloading %s failed:' % destfn
+        traceback.print_exc()
+        ok = False
+      self._RecordFirstByteTime(host, fetcher.first_byte_time)
+      try:
+        if callback:
+          callback(entry, destfn, ok)
+      except Exception:
+        print 'Recording the download of %s failed:' % destfn
+        traceback.print_exc()
+      self._lock.acquire()
+      self._pending.discard(entry.Key())
+      self._lock.release()
+
+  def Pending(self, entry):
+    """Returns whether entry is queued or being downloaded."""
+    return entry.Key() in self._pending
+
+  def Add(self, fetcher, entry, destfn, callback=None):
+    """Queues entry to be downloaded from fetcher's tivo to destfn.  If given,
+    callback(entry, destfn, ok) is called from the worker when it's done.
+
+    Returns False, and does nothing, if the same recording is already queued
+    or being downloaded, from this tivo or another."""
+    host = fetcher.tivo_host
+    self._lock.acquire()
+    try:
+      if entry.Key() in self._pending:
+        return False
+      self._pending.add(entry.Key())
+      if host not in self._queues:
+        self._queues[host] = Queue.Queue()
+        self._threads[host] = threading.Thread(target=self._Worker,
+            args=(host, self._queues[host]))
+        self._threads[host].start()
+      self._queues[host].put((fetcher, entry, destfn, callback))
+    finally:
+      self._lock.release()
+    return True
+
+  def Wait(self):
+    """Waits for everything queued to be downloaded."""
+    for queue in self._queues.values():
+      queue.put(None)
+    for thread in self._threads.values():
+      thread.join()
+    self._queues = {}
+    self._threads = {}
+
+
+def FetchPlayLists(hosts, media_key, **fetcher_args):
+  """Fetches the NowPlaying lists from all of hosts at once.
+
+  Returns a dict of host to its list of PlayListEntry."""
+  pool = TivoPool(media_key, **fetcher_args)
+  results = [(host, pool.FetchPlayList(host)) for host in hosts]
+  try:
+    return dict([(host, result.get()) for host, result in results])
+  finally:
+    pool.Close()
+
+
+# FindTivos keeps the tivos it finds in HOSTS_CACHE, and uses that instead of
+# waiting on mdns if it's less than HOSTS_CACHE_TTL seconds old.  If it's more
+# than HOSTS_CACHE_REFRESH seconds old, it's refreshed in the background.
+HOSTS_CACHE = os.path.expanduser('~/.tivo_hosts')
+HOSTS_CACHE_TTL = 24*60*60
+HOSTS_CACHE_REFRESH = 5*60
+
+
+def _ReadHostsCache():
+  """Returns (time, hosts) from the hosts cache, or None if there isn't a
+  usable one."""
+  try:
+    cache = json.load(open(HOSTS_CACHE))
+    hosts = []
+    for record in cache['hosts']:
+      # Caches from before we kept the TXT data just have addresses.
+      if not isinstance(record, dict):
+        record = {'address': record}
+      # json gives back unicode, which httplib shouldn't be sent.
+      hosts.append(TivoHost(**dict([
+          (str(key), isinstance(value, unicode) and value.encode('utf-8')
+                     or value)
+          for key, value in record.items()])))
+    return cache['time'], hosts
+  except (IOError, ValueError, KeyError, TypeError):
+    return None
+
+
+def _WriteHostsCache(hosts):
+  # Write and rename, since the cache may be refreshed from the background
+  # while another run is reading it.
+  tmpfn = '%s.%d' % (HOSTS_CACHE, os.getpid())
+  fp = open(tmpfn, 'w')
+  json.dump({'time': time.time(), 'hosts': [vars(host) for host in hosts]},
+            fp)
+  fp.close()
+  os.rename(tmpfn, HOSTS_CACHE)
+
+
+def _UpdateHostsCache():
+  """Looks for tivos, and updates the cache with what it finds."""
+  hosts = list(IterTivos())
+  # A tivo may just not have answered in time, don't forget the ones we know
+  # about because of it.
+  if hosts:
+    _WriteHostsCache(hosts)
+
+
+def _RefreshHostsCache():
+  """Runs _UpdateHostsCache in the background, in a new python process.
+
+  avahi needs a running glib main loop, so it's kept out of our process
+  entirely rather than in a thread.  The new process is started from a
+  short-lived child, which we wait for, so nothing is left for us to reap,
+  and it execs a fresh python rather than carrying on with a copy of our
+  threads and connections."""
+  pid = os.fork()
+  if pid == 0:
+    try:
+      if os.fork() == 0:
+        os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+        os.execv(sys.executable, [
+            sys.executable, '-c',
+            'import sys; sys.path.insert(0, %r); import TivoAccess; '
+            'TivoAccess._UpdateHostsCache()' %
+            os.path.dirname(os.path.abspath(__file__))])
+    finally:
+      os._exit(0)
+  os.waitpid(pid, 0)
+
+
+def FindTivos(use_cache=True):
+  """Returns a TivoHost for each tivo on the network."""
+  if use_cache:
+    cache = _ReadHostsCache()
+    if cache is not None:
+      cache_time, hosts = cache
+      age = time.time() - cache_time
+      if age < HOSTS_CACHE_TTL:
+        if age > HOSTS_CACHE_REFRESH:
+          _RefreshHostsCache()
+        return hosts
+  hosts = list(IterTivos())
+  # As in _RefreshHostsCache, finding nothing is more likely a network or
+  # avahi hiccup than every tivo going away, and caching that would leave
+  # the next runs finding nothing too.
+  if hosts:
+    try:
+      _WriteHostsCache(hosts)
+    except (IOError, OSError):
+      pass
+  return hosts
+
 
-    return results
+def IterTivos(timeout=3000, expected=None):
+  """Yields each tivo's TivoHost as soon as mdns finds it, so the caller can
+  get started on the first tivo while we're still looking for the rest.
+  Stops after timeout milliseconds, or when expected tivos have been found."""
+  for service in _FindHosts().IterServices('tivo-videos', timeout,
+                                           expected):
+    yield _HostFromService(service)
 
 
-# What should we return if we don't have a mdns client?  Should this return an
-# exception instead?
-def FindTivos():
-  if not has_avahi: return []
-  return avahi_find_hosts.ReturnHosts('tivo-videos')
+def TivoWatcher(added=None, removed=None):
+  """Returns a watcher which keeps looking for tivos once it's Run(), and
+  calls added(host) as soon as a tivo appears on the network and
+  removed(host) when one goes away, with the tivo's TivoHost.  Stop() it to
+  finish."""
+  watcher = _FindHosts().ServiceWatcher('tivo-videos')
+  def Host(callback):
+    if callback is None:
+      return None
+    return lambda service: callback(_HostFromService(service))
+  watcher.Subscribe(Host(added), Host(removed))
+  return watcher
 
 
 # Load the Tivo Media Access Key from the ~/.tivodecode_mak file
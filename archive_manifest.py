@@ -0,0 +1,74 @@
+# Copyright (c) 2008, Brandon Long
+# -*- coding: utf-8 -*-
+#
+# A record of which recordings have been archived off the tivos.
+#
+# The manifest is a small sqlite database, keyed by PlayListEntry.Key(), so a
+# recording is still known to be archived after its file has been moved or
+# renamed.  The whole thing is read into memory when it's opened, so checking
+# an entry doesn't touch the database or the filesystem.
+#
+
+import os
+import sqlite3
+import threading
+import time
+
+# Status values for a recording in the manifest.
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Manifest:
+  def __init__(self, filename):
+    self.filename = filename
+    # The download scheduler records results from its worker threads.
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(filename, check_same_thread=False)
+    self._db.execute('CREATE TABLE IF NOT EXISTS recordings ('
+                     'key TEXT PRIMARY KEY, title TEXT, filename TEXT, '
+                     'size INTEGER, status TEXT, completed REAL)')
+    self._db.commit()
+    # key -> (status, filename)
+    self.recordings = {}
+    for key, status, fn in self._db.execute(
+        'SELECT key, status, filename FROM recordings'):
+      self.recordings[key] = (status, fn)
+
+  def Close(self):
+    self._db.close()
+
+  def Status(self, entry):
+    """Returns the status of entry in the manifest, or None if it's not in
+    it."""
+    record = self.recordings.get(entry.Key())
+    if record is None:
+      return None
+    return record[0]
+
+  def Has(self, entry, filename=None):
+    """Returns whether entry has been archived.
+
+    If entry isn't in the manifest but filename exists, it was archived before
+    we kept a manifest, and is added to it as done."""
+    record = self.recordings.get(entry.Key())
+    if record is not None:
+      return record[0] == DONE
+    if filename and os.path.exists(filename):
+      self.Record(entry, filename, DONE, os.path.getsize(filename))
+      return True
+    return False
+
+  def Record(self, entry, filename, status, size=None):
+    """Records the result of archiving entry to filename."""
+    key = entry.Key()
+    self._lock.acquire()
+    try:
+      self._db.execute('INSERT OR REPLACE INTO recordings '
+                       '(key, title, filename, size, status, completed) '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, entry.title, filename, size, status, time.time()))
+      self._db.commit()
+      self.recordings[key] = (status, filename)
+    finally:
+      self._lock.release()
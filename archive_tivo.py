@@ -2,15 +2,29 @@
 # 
 # archive_tivo is a quick example of a program to selectively copy some 
 # video's off your tivo
+#
+# With --watch, it keeps running, and archives from each tivo as soon as it
+# turns up on the network.
 
 import sys
 import os
-import time
+import threading
 import TivoAccess
+import archive_manifest
 import progrun
+import subscriptions
 
 
 DOWNLOAD = os.path.expanduser('~/Downloads')
+# Number of NowPlaying pages to fetch from each tivo at once
+PAGE_WORKERS = 3
+# Which shows to archive, see subscriptions.py for the format.  If there's no
+# subscriptions file, DEFAULT_SUBSCRIPTIONS are archived.
+SUBSCRIPTIONS = os.path.expanduser('~/.archive_tivo_subscriptions')
+DEFAULT_SUBSCRIPTIONS = ['South Park', 'Robot Chicken', 'Venture', 'NHL']
+# With --watch, how often to look for new shows on the tivos which are still
+# around, in seconds.  With a playlist cache this is usually one small page.
+RESYNC_INTERVAL = 15 * 60
 
 
 def EntryFilename(entry):
@@ -24,33 +38,138 @@ def EntryFilename(entry):
   return os.path.join(DOWNLOAD, fn)
 
 
+def LoadSubscriptions():
+  if os.path.exists(SUBSCRIPTIONS):
+    return subscriptions.Load(SUBSCRIPTIONS)
+  return subscriptions.Subscriptions([subscriptions.Rule(title=title)
+                                      for title in DEFAULT_SUBSCRIPTIONS])
+
+
+def RecordDownload(manifest, entry, destfn, ok):
+  if ok:
+    manifest.Record(entry, destfn, archive_manifest.DONE,
+                    os.path.getsize(destfn))
+  else:
+    manifest.Record(entry, destfn, archive_manifest.FAILED)
+
+
+def QueueMatches(host, entries, tf, subs, manifest, scheduler):
+  """Queues the entries from host which are subscribed to and haven't been
+  archived or queued yet."""
+  matching = []
+  for entry in subs.Filter(entries):
+    if entry.inprogress: continue
+    if manifest.Has(entry, EntryFilename(entry)): continue
+    # With --watch, a tivo can turn up again while its downloads are still
+    # going.
+    if scheduler.Pending(entry): continue
+    matching.append(entry)
+
+  if len(matching):
+    print "Tivo %s has %d shows, %d to download" % (host, len(entries),
+        len(matching))
+    for entry in matching:
+      print "Queueing %s" % EntryFilename(entry)
+      scheduler.Add(tf, entry, EntryFilename(entry),
+          lambda entry, destfn, ok: RecordDownload(manifest, entry, destfn,
+                                                   ok))
+
+
+def Archive(host, playlist, pool, subs, manifest, scheduler):
+  """Waits for the playlist fetched from host, and queues what should be
+  archived from it.  A tivo which can't be reached is reported and skipped,
+  so it doesn't hold up the others."""
+  try:
+    entries = playlist.get()
+  except Exception, reason:
+    print "Unable to fetch the playlist from tivo %s: %s" % (host, reason)
+    return
+  QueueMatches(host, entries, pool.Fetcher(host), subs, manifest, scheduler)
+
+
+def Watch(pool, subs, manifest, scheduler):
+  """Archives from each tivo as soon as it turns up on the network, and again
+  every RESYNC_INTERVAL while it stays, until interrupted."""
+  # host.Key() -> host, for the tivos on the network now.
+  hosts = {}
+  lock = threading.Lock()
+  stopped = threading.Event()
+
+  def Added(host):
+    print "Found tivo %s" % host
+    lock.acquire()
+    try:
+      hosts[host.Key()] = host
+    finally:
+      lock.release()
+    # Don't hold up the watcher while the playlist comes in.
+    threading.Thread(target=Archive,
+                     args=(host, pool.FetchPlayList(host), pool, subs,
+                           manifest, scheduler)).start()
+
+  def Removed(host):
+    print "Lost tivo %s" % host
+    lock.acquire()
+    try:
+      hosts.pop(host.Key(), None)
+    finally:
+      lock.release()
+
+  def Resync():
+    while 1:
+      stopped.wait(RESYNC_INTERVAL)
+      if stopped.isSet():
+        return
+      lock.acquire()
+      try:
+        current = hosts.values()
+      finally:
+        lock.release()
+      playlists = [(host, pool.FetchPlayList(host)) for host in current]
+      for host, playlist in playlists:
+        Archive(host, playlist, pool, subs, manifest, scheduler)
+
+  resync = threading.Thread(target=Resync)
+  resync.daemon = True
+  resync.start()
+  try:
+    TivoAccess.TivoWatcher(Added, Removed).Run()
+  finally:
+    stopped.set()
+    resync.join()
+
+
 def main(argv):
   try:
     progrun.do_lock('/tmp/archive_tivo.lock')
   except progrun.LockFailed:
     return
 
+  manifest = archive_manifest.Manifest(os.path.join(DOWNLOAD,
+                                                     '.archive_tivo.db'))
+  subs = LoadSubscriptions()
   media_key = TivoAccess.LoadMak()
-  hosts = TivoAccess.FindTivos()
-  for host in hosts:
-    tf = TivoAccess.TivoFetcher(host, media_key)
-    entries = tf.FetchPlayList()
-    matching = []
-    for entry in entries:
-      if entry.inprogress: continue
-      for dl in ['South Park', 'Robot Chicken', 'Venture', 'NHL']:
-        if entry.title.find(dl) != -1:
-          if os.path.exists(EntryFilename(entry)): continue
-          matching.append(entry)
-
-    if len(matching):
-      print "Tivo %s has %d shows, %d to download" % (host, len(entries),
-          len(matching))
-      for entry in matching:
-        print "Downloading %s" % EntryFilename(entry)
-        tf.Download(entry, EntryFilename(entry))
-        # wait 15s between downloads to let the tivo recover
-        time.sleep(15)
+  pool = TivoAccess.TivoPool(media_key, page_workers=PAGE_WORKERS,
+                             playlist_cache=TivoAccess.PLAYLIST_CACHE)
+  # Download from all the tivos at once, one show at a time from each.
+  scheduler = TivoAccess.DownloadScheduler()
+  # The scheduler's workers wait for more downloads until told otherwise, so
+  # whatever happens, let them finish, or we'd never exit and would hold
+  # the lock forever.
+  try:
+    if '--watch' in argv[1:]:
+      Watch(pool, subs, manifest, scheduler)
+    else:
+      # Fetch every tivo's playlist at once, and work through them as they
+      # come in.
+      hosts = TivoAccess.FindTivos()
+      playlists = [(host, pool.FetchPlayList(host)) for host in hosts]
+      for host, playlist in playlists:
+        Archive(host, playlist, pool, subs, manifest, scheduler)
+  finally:
+    pool.Close()
+    scheduler.Wait()
+    manifest.Close()
 
 
 if __name__ == "__main__":
@@ -47,6 +47,7 @@ import avahi.ServiceTypeDatabase
 # Automatically sets the default mainloop for dbus to a Glib provided one.
 # Needed to get signals to work.
 import dbus.glib
+import dbus.mainloop.glib
 
 debug = False
 
@@ -138,22 +139,41 @@ class AvahiServices(object):
     """A class to encapsulate the business of talking to the avahi-daemon over
     the D-bus."""
     
-    def __init__(self, domain, loop):
-        """Sets up the connection to avahi-daemon over D-bus."""
+    def __init__(self, domain, loop, bus=None, server=None):
+        """Sets up the connection to avahi-daemon over D-bus.
+
+        A bus and avahi server interface can be passed in, for testing
+        against fakes."""
         
         # Connect to the system bus...
-        self.bus = dbus.SystemBus()
-        # Get a proxy to the object we want to talk to.
-        avahi_proxy = self.bus.get_object(avahi.DBUS_NAME,
-                                          avahi.DBUS_PATH_SERVER)
-        # Set the interface we want to use; server in this case.
-        self.server = dbus.Interface(avahi_proxy, 
-                                     avahi.DBUS_INTERFACE_SERVER)
+        if bus is None:
+            bus = dbus.SystemBus()
+        self.bus = bus
+        if server is None:
+            # Get a proxy to the object we want to talk to.
+            avahi_proxy = self.bus.get_object(avahi.DBUS_NAME,
+                                              avahi.DBUS_PATH_SERVER)
+            # Set the interface we want to use; server in this case.
+            server = dbus.Interface(avahi_proxy, 
+                                    avahi.DBUS_INTERFACE_SERVER)
+        self.server = server
         
         self.version_string = self.server.GetVersionString()
         self.domain = domain
         self.loop = loop
         self.services = {}
+        # Keys of the services we've asked avahi to resolve, and haven't
+        # heard back about yet.
+        self.resolving = set()
+        # Set once avahi has said it's told us everything it knows.
+        self.all_for_now_seen = False
+        # Set once avahi has told us about everything it knows and it has
+        # all been resolved, or the caller has given up waiting.
+        self.finished = False
+        # If set, called with each Service as it is resolved.
+        self.callback = None
+        # If set, called with each resolved Service which goes away.
+        self.remove_callback = None
 
     def browse_service_type(self, stype):
         """Sets up call back methods to browse for a specific service type"""
@@ -179,12 +199,48 @@ class AvahiServices(object):
         """Callback method used to handle a new service has appearing, or
         a known one being retrieved from avahi-daemon's cache.
 
-        Adds a Service object to our collection.  """
+        Starts resolving the service.  The resolve is an asynchronous
+        D-bus call, so a slow or stale responder doesn't hold up the
+        others; resolved() adds it to our collection when it's done.  """
         
-        service = Service(*self.server.ResolveService(
+        key = (interface, protocol, name, stype, domain)
+        self.resolving.add(key)
+        self.server.ResolveService(
             interface, protocol, name, stype, domain,
-            avahi.PROTO_UNSPEC, dbus.UInt32(0)))
+            avahi.PROTO_UNSPEC, dbus.UInt32(0),
+            reply_handler=self.resolved,
+            error_handler=lambda error, key=key:
+                self.resolve_error(key, error))
+
+    def resolved(self, *args):
+        """Callback for a successful ResolveService call.
+
+        Adds a Service object to our collection, unless the service has
+        gone away while we were resolving it."""
+        service = Service(*args)
+        if service.key() not in self.resolving:
+            return
+        self.resolving.discard(service.key())
         self.services[service.key()] = service
+        if self.callback:
+            self.callback(service)
+        self.check_finished()
+
+    def resolve_error(self, key, error):
+        """Callback for a failed ResolveService call for the service with
+        the given key.
+
+        We'll never hear back about it, so stop waiting on it."""
+        if debug:
+            print >>sys.stderr, "Resolve of %s failed: %s" % (key[2], error)
+        self.resolving.discard(key)
+        self.check_finished()
+
+    def check_finished(self):
+        """Finishes once avahi has said all for now, and every resolve has
+        either come back or failed."""
+        if self.all_for_now_seen and not self.resolving:
+            self.finish()
 
     def remove_service(self, interface, protocol, name, stype, domain):
         """Callback method to handle a service has going away.
@@ -192,10 +248,12 @@ class AvahiServices(object):
         Removes the matching Service object if it exists.
         """
         
-        try:
-            del self.services[(interface, protocol, name, stype, domain)]
-        except KeyError:
-            pass
+        key = (interface, protocol, name, stype, domain)
+        self.resolving.discard(key)
+        service = self.services.pop(key, None)
+        if service is not None and self.remove_callback:
+            self.remove_callback(service)
+        self.check_finished()
 
     def all_for_now(self):
         """A callback to handle the 'all for now' signal.
@@ -204,8 +262,68 @@ class AvahiServices(object):
         of the types we asked for, that avahi presently knows about.
 
         Exits the mainloop, returning control back to where the loop was
-        first run.
+        first run, once the outstanding resolves have come back.
+        """
+        self.all_for_now_seen = True
+        self.check_finished()
+
+    def finish(self):
+        """Stops browsing, whether or not we've heard everything."""
+        self.finished = True
+        self.loop.quit()
+        # Returning False removes us if we were called from a glib timeout.
+        return False
+
+
+class ServiceWatcher(object):
+    """Keeps browsing for a service, and tells subscribers as soon as a
+    host advertising it appears or goes away.
+
+    The live map of services is kept in self.browser.services."""
+
+    def __init__(self, service_name, domain='local'):
+        # The watcher is meant to run alongside threads doing real work.
+        # Without thread support, the glib loop holds the GIL while it waits
+        # and they never get to run.
+        gobject.threads_init()
+        dbus.mainloop.glib.threads_init()
+        self.loop = gobject.MainLoop()
+        self.browser = AvahiServices(domain, self.loop)
+        self.browser.callback = self._added
+        self.browser.remove_callback = self._removed
+        self.stype = service_type(service_name)
+        self.subscribers = []
+        self.stopped = False
+
+    def Subscribe(self, added=None, removed=None):
+        """Arranges for added(service) and removed(service) to be called as
+        services come and go.  They're called from the thread running Run().
         """
+        self.subscribers.append((added, removed))
+
+    def _added(self, service):
+        for added, removed in self.subscribers:
+            if added:
+                added(service)
+
+    def _removed(self, service):
+        for added, removed in self.subscribers:
+            if removed:
+                removed(service)
+
+    def Run(self):
+        """Browses until Stop() is called."""
+        self.browser.browse_service_type(self.stype)
+        while not self.stopped:
+            # AllForNow quits the loop, which only matters to one-shot
+            # lookups, so keep on running it.
+            try:
+                self.loop.run()
+            except KeyboardInterrupt:
+                self.Stop()
+
+    def Stop(self):
+        self.stopped = True
         self.loop.quit()
 
 
@@ -245,37 +363,66 @@ def make_url(service, scheme, use_host_names):
 
     return "%s://%s%s%s" % (scheme, user, host, path)
 
-def ReturnHosts(service_name, return_addrs=True):
-    # Provide the Glib mainloop, so signals work.
-    loop = gobject.MainLoop()
-    gobject.timeout_add(3000, loop.quit)
-
-    browser = AvahiServices('local', loop)
+def service_type(service_name):
+    """Returns the DNS service type to browse for service_name.
 
-    # Set up browsing for the service type the user is interested in.
-    # We look up aliases, use the full _foo._prot form, or take a guess.
+    We look up aliases, use the full _foo._prot form, or take a guess."""
     if service_map.has_key(service_name):
-        stype = service_map[service_name]['stype']
-    else:        
-        if service_name[0] == '_':
-            stype = service_name
-        else:
-            stype = "_%s._tcp" % service_name
-    browser.browse_service_type(stype)
+        return service_map[service_name]['stype']
+    if service_name[0] == '_':
+        return service_name
+    return "_%s._tcp" % service_name
+
+def IterServices(service_name, timeout=3000, expected=None, domain='local'):
+    """Yields each Service advertising service_name as soon as it has been
+    resolved.
+
+    Stops when avahi says it has told us everything it knows, after timeout
+    milliseconds, or once expected services have been found."""
+    # Provide the Glib mainloop, so signals work.  We run it a step at a
+    # time ourselves, so we can hand back services as they turn up.
+    loop = gobject.MainLoop()
+    context = loop.get_context()
 
-    try:
-        # Run the loop! This waits around until the avahi daemon sends
-        # us messages about the services found, and gives us the
-        # "all for now" message. Or the user gets bored and interupts the
-        # process with ctrl-c.
-        loop.run()
-    except KeyboardInterrupt:
-        pass
+    browser = AvahiServices(domain, loop)
+    resolved = []
+    browser.callback = resolved.append
+    timer = gobject.timeout_add(timeout, browser.finish)
+    browser.browse_service_type(service_type(service_name))
 
+    found = 0
+    try:
+        while 1:
+            # This waits around until the avahi daemon sends us messages
+            # about the services found, and gives us the "all for now"
+            # message. Or the user gets bored and interupts the process
+            # with ctrl-c.
+            try:
+                context.iteration(True)
+            except KeyboardInterrupt:
+                browser.finish()
+            while resolved:
+                yield resolved.pop(0)
+                found += 1
+                if expected and found >= expected:
+                    return
+            if browser.finished:
+                return
+    finally:
+        gobject.source_remove(timer)
+
+def ReturnHosts(service_name, return_addrs=True, timeout=3000, expected=None,
+                callback=None):
+    """Returns the hosts advertising service_name.
+
+    If given, callback is called with each host as soon as it is found,
+    before the rest have been.  See IterServices for timeout and expected."""
     r = []
-    for s in browser.services:
-        r.append(get_host(browser.services[s], not return_addrs))
-    
+    for service in IterServices(service_name, timeout, expected):
+        host = get_host(service, not return_addrs)
+        if callback:
+            callback(host)
+        r.append(host)
     return r
 
 def main(argv=None):
@@ -297,14 +444,7 @@ def main(argv=None):
     browser = AvahiServices(options.domain, loop)
 
     # Set up browsing for the service type the user is interested in.
-    # We look up aliases, use the full _foo._prot form, or take a guess.
-    if service_map.has_key(args[0]):
-        stype = service_map[args[0]]['stype']
-    else:        
-        if args[0][0] == '_':
-            stype = args[0]
-        else:
-            stype = "_%s._tcp" % args[0]
+    stype = service_type(args[0])
     browser.browse_service_type(stype)
 
     try:
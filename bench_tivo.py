@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# bench_tivo times the parts of TivoAccess which get slow on tivos with a lot
+# of recordings, against generated data so no tivo is needed.
+#
+#   bench_tivo.py [benchmark ...]
+#
+# With no arguments, every benchmark is run.
+
+import os
+import random
+import subprocess
+import sys
+import time
+import StringIO
+import TivoAccess
+import subscriptions
+
+
+def SampleItem(i, host='192.168.1.20'):
+  """Returns the XML for one NowPlaying Item, shaped like a real tivo's."""
+  if i % 11 == 0:
+    flags = '<CopyProtected>Yes</CopyProtected>'
+  elif i % 97 == 0:
+    flags = '<InProgress>Yes</InProgress>'
+  else:
+    flags = ''
+  return ('<Item><Details><ContentType>video/x-tivo-raw-tts</ContentType>'
+          '<SourceFormat>video/x-tivo-raw-tts</SourceFormat>'
+          '<Title>Show %d &amp; Caf\xc3\xa9</Title>'
+          '<SourceSize>%d</SourceSize><Duration>1800000</Duration>'
+          '<CaptureDate>0x%X</CaptureDate>'
+          '<EpisodeTitle>Episode &quot;%d&quot;</EpisodeTitle>'
+          '<Description>Something happens in episode %d. Copyright Tribune '
+          'Media Services, Inc.</Description>'
+          '<SourceChannel>%d</SourceChannel>'
+          '<SourceStation>STN%d</SourceStation>'
+          '<HighDefinition>No</HighDefinition><ProgramId>EP%08d</ProgramId>'
+          '<SeriesId>SH%06d</SeriesId>%s</Details>'
+          '<Links><Content><Url>http://%s:80/download/Show.TiVo?'
+          'Container=%%2FNowPlaying&amp;id=%d</Url>'
+          '<ContentType>video/x-tivo-raw-tts</ContentType></Content>'
+          '<CustomIcon><Url>urn:tivo:image:save-until-i-delete-recording</Url>'
+          '<ContentType>image/*</ContentType></CustomIcon>'
+          '<TiVoVideoDetails><Url>https://%s:443/TiVoVideoDetails?id=%d</Url>'
+          '<ContentType>text/xml</ContentType></TiVoVideoDetails></Links>'
+          '</Item>') % (i, 1000000000 + i * 1024, 0x49000000 + i * 1800, i, i,
+                        700 + i % 80, i % 80, i, i % 300, flags, host,
+                        100000 + i, host, 100000 + i)
+
+
+def SampleContainer(nitems, total=None, start=0):
+  """Returns a NowPlaying TiVoContainer document with nitems Items."""
+  if total is None:
+    total = nitems
+  return ('<?xml version="1.0" encoding="utf-8" ?>\n'
+          '<TiVoContainer xmlns="http://www.tivo.com/developer/calypso-protocol-1.6/">'
+          '<Details><ContentType>x-tivo-container/tivo-dvr</ContentType>'
+          '<SourceFormat>x-tivo-container/tivo-dvr</SourceFormat>'
+          '<Title>Now Playing</Title><LastChangeDate>0x4A3B2C1D</LastChangeDate>'
+          '<TotalItems>%d</TotalItems><UniqueId>/NowPlaying</UniqueId></Details>'
+          '<SortOrder>Type,CaptureDate</SortOrder><GlobalSort>Yes</GlobalSort>'
+          '<ItemStart>%d</ItemStart><ItemCount>%d</ItemCount>%s'
+          '</TiVoContainer>') % (total, start, nitems,
+              ''.join([SampleItem(i) for i in range(start, start + nitems)]))
+
+
+def Time(fn, repeat=3):
+  """Returns the best wall clock time of repeat calls to fn."""
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def BenchPlayListParse(nitems=2000):
+  """Parsing one big NowPlaying page: the original BeautifulStoneSoup call,
+  the soup fallback as _ParseSoupPage has it now, and tivo_container."""
+  import BeautifulSoup
+  doc = SampleContainer(nitems)
+  tf = TivoAccess.TivoFetcher('localhost', '')
+
+  def OriginalSoup(f):
+    # How every page was parsed before tivo_container.
+    soup = BeautifulSoup.BeautifulStoneSoup(f.read())
+    totalcount = int(soup.tivocontainer.details.totalitems.string)
+    return totalcount, [tf._ParseSoupItem(item)
+                        for item in soup.tivocontainer.findAll('item')]
+
+  total, entries = tf._ParsePage(StringIO.StringIO(doc))
+  for parse in (OriginalSoup, tf._ParseSoupPage):
+    soup_total, soup_entries = parse(StringIO.StringIO(doc))
+    assert soup_total == total
+    assert [vars(e) for e in soup_entries] == [vars(e) for e in entries]
+
+  original_time = Time(lambda: OriginalSoup(StringIO.StringIO(doc)))
+  soup_time = Time(lambda: tf._ParseSoupPage(StringIO.StringIO(doc)))
+  expat_time = Time(lambda: tf._ParsePage(StringIO.StringIO(doc)))
+  print 'playlist_parse: %d items, %d bytes' % (nitems, len(doc))
+  print '  BeautifulStoneSoup  %8.3fs' % original_time
+  print '  _ParseSoupPage      %8.3fs  (%.1fx)' % (soup_time,
+                                                   original_time / soup_time)
+  print '  tivo_container      %8.3fs  (%.1fx)' % (expat_time,
+                                                   original_time / expat_time)
+
+
+def BenchSoupNavigation(nitems=2000):
+  """Turning a parsed soup into PlayListEntry objects, with tag.name lookups
+  searching the tree each time vs Tag's name index."""
+  import BeautifulSoup
+  doc = SampleContainer(nitems)
+  tf = TivoAccess.TivoFetcher('localhost', '')
+  soup = BeautifulSoup.BeautifulStoneSoup(doc)
+  items = soup.tivocontainer.findAll('item')
+  def Entries():
+    return [tf._ParseSoupItem(item) for item in items]
+
+  indexed_entries = Entries()
+  indexed_time = Time(Entries)
+  findByName = BeautifulSoup.Tag._findByName
+  BeautifulSoup.Tag._findByName = BeautifulSoup.Tag.find
+  try:
+    assert [vars(e) for e in Entries()] == [vars(e) for e in indexed_entries]
+    find_time = Time(Entries)
+  finally:
+    BeautifulSoup.Tag._findByName = findByName
+  print 'soup_navigation: %d items' % nitems
+  print '  find() per lookup   %8.3fs' % find_time
+  print '  name index          %8.3fs  (%.1fx)' % (indexed_time,
+                                                   find_time / indexed_time)
+
+
+def BenchSoupMemory(nitems=2000):
+  """The memory taken by the nodes of a parsed NowPlaying soup, against the
+  same tree without __slots__.
+
+  Tags used to be old-style instances and strings unicode subclasses, each
+  with its attributes in a __dict__, so the unslotted tree is a copy of each
+  node made that way, with the attributes the slotted node has set."""
+  import BeautifulSoup
+  class UnslottedTag:
+    pass
+  class UnslottedString(unicode):
+    pass
+
+  def NodeSize(node):
+    size = sys.getsizeof(node)
+    try:
+      size += sys.getsizeof(node.__dict__)
+    except AttributeError:
+      pass
+    return size
+
+  soup = BeautifulSoup.BeautifulStoneSoup(SampleContainer(nitems))
+  nodes = 0
+  slotted = 0
+  unslotted = 0
+  for node in soup.recursiveChildGenerator():
+    nodes += 1
+    if isinstance(node, BeautifulSoup.Tag):
+      copy = UnslottedTag()
+      contents = sys.getsizeof(node.contents) + sys.getsizeof(node.attrs)
+    else:
+      # Sliced, as unicode() would go through NavigableString.__unicode__.
+      copy = UnslottedString(node[:])
+      contents = 0
+    copy.__dict__.update(node.__getstate__())
+    slotted += NodeSize(node) + contents
+    unslotted += NodeSize(copy) + contents
+  print 'soup_memory: %d items, %d nodes' % (nitems, nodes)
+  for label, size in (('__dict__ nodes', unslotted),
+                      ('__slots__ nodes', slotted)):
+    print '  %-19s %8.1fMB  (%d bytes per node)' % (
+        label, size / 1048576.0, size / nodes)
+  print '  %-19s %8.1fx' % ('saving', float(unslotted) / slotted)
+
+
+def BenchSoupTrustedXML(sizes=(50, 2000)):
+  """Parsing NowPlaying pages into a soup, with and without trustedXML.
+
+  trustedXML only changes what happens to the markup before sgmllib sees it,
+  so that's timed on its own as well, with a soup which stops there."""
+  import BeautifulSoup
+  Soup = BeautifulSoup.BeautifulStoneSoup
+  class UntokenizedSoup(Soup):
+    def goahead(self, end):
+      pass
+
+  for nitems in sizes:
+    doc = SampleContainer(nitems)
+    assert str(Soup(doc, trustedXML=True)) == str(Soup(doc))
+    repeat = max(1, 1000 / nitems)
+    def PerPage(soup_class, **kwargs):
+      return Time(lambda: [soup_class(doc, **kwargs)
+                           for i in range(repeat)]) / repeat
+    print 'soup_trusted_xml: %d items, %d bytes' % (nitems, len(doc))
+    for label, soup_class in (('preparing markup', UntokenizedSoup),
+                              ('whole parse', Soup)):
+      default_time = PerPage(soup_class)
+      trusted_time = PerPage(soup_class, trustedXML=True)
+      print '  %-19s %8.4fs, trustedXML %8.4fs  (%.1fx)' % (
+          label, default_time, trusted_time, default_time / trusted_time)
+
+
+def BenchSoupTokenizer(nitems=2000):
+  """Parsing one big NowPlaying page into a soup, tokenized by SGMLParser vs
+  expat."""
+  import BeautifulSoup
+  Soup = BeautifulSoup.BeautifulStoneSoup
+  doc = SampleContainer(nitems)
+  expat = BeautifulSoup.ExpatTokenizer
+  assert str(Soup(doc, tokenizer=expat)) == str(Soup(doc))
+  sgml_time = Time(lambda: Soup(doc, trustedXML=True))
+  expat_time = Time(lambda: Soup(doc, trustedXML=True, tokenizer=expat))
+  print 'soup_tokenizer: %d items, %d bytes' % (nitems, len(doc))
+  print '  SGMLParser          %8.3fs' % sgml_time
+  print '  ExpatTokenizer      %8.3fs  (%.1fx)' % (expat_time,
+                                                   sgml_time / expat_time)
+
+
+def BenchSubscriptions(nentries=10000, nrules=1000):
+  """Matching a playlist against many subscriptions, a find() per title and
+  rule vs the compiled subscriptions.Subscriptions."""
+  rand = random.Random(42)
+  words = ['Late', 'Night', 'Show', 'News', 'Hockey', 'Park', 'South', 'Bros',
+           'Chicken', 'Robot', 'Venture', 'Cooking', 'House', 'Law', 'Order',
+           'Star', 'Trek', 'Nova', 'Frontline', 'Simpsons']
+  def Title():
+    return ' '.join([rand.choice(words) for i in range(rand.randint(1, 4))])
+  titles = [Title() + ' %d' % rand.randint(0, nrules * 4)
+            for i in range(nentries)]
+  patterns = ['%s %d' % (rand.choice(words), i) for i in range(nrules)]
+  entries = []
+  for title in titles:
+    entry = TivoAccess.PlayListEntry()
+    entry.title = title
+    entries.append(entry)
+
+  def Naive():
+    matching = []
+    for entry in entries:
+      for dl in patterns:
+        if entry.title.find(dl) != -1:
+          matching.append(entry)
+          break
+    return matching
+
+  subs = subscriptions.Subscriptions([subscriptions.Rule(title=pattern)
+                                      for pattern in patterns])
+  assert Naive() == list(subs.Filter(entries))
+
+  build_time = Time(lambda: subscriptions.Subscriptions(
+      [subscriptions.Rule(title=pattern) for pattern in patterns]))
+  naive_time = Time(Naive)
+  subs_time = Time(lambda: list(subs.Filter(entries)))
+  print 'subscriptions: %d entries, %d rules, %d matches' % (
+      nentries, nrules, len(Naive()))
+  print '  find() per rule     %8.3fs' % naive_time
+  print '  Subscriptions       %8.3fs  (%.1fx, plus %.3fs to compile)' % (
+      subs_time, naive_time / subs_time, build_time)
+
+
+def BenchImport():
+  """Starting a python which imports TivoAccess, vs one which goes on to load
+  everything TivoAccess used to import up front."""
+  here = os.path.dirname(os.path.abspath(__file__))
+  def Python(code):
+    subprocess.check_call([sys.executable, '-c', code], cwd=here)
+
+  eager = ('import TivoAccess, BeautifulSoup, html_unescape, tivo_http, '
+           'multiprocessing.pool; TivoAccess._FindHosts()')
+  bare_time = Time(lambda: Python('pass'), repeat=5)
+  lazy_time = Time(lambda: Python('import TivoAccess'), repeat=5)
+  eager_time = Time(lambda: Python(eager), repeat=5)
+  print 'import: TivoAccess, less %.3fs to start python' % bare_time
+  print '  everything up front %8.3fs' % (eager_time - bare_time)
+  print '  as needed           %8.3fs  (%.1fx)' % (
+      lazy_time - bare_time,
+      (eager_time - bare_time) / max(lazy_time - bare_time, 0.001))
+
+
+BENCHMARKS = [
+  ('playlist_parse', BenchPlayListParse),
+  ('soup_navigation', BenchSoupNavigation),
+  ('soup_memory', BenchSoupMemory),
+  ('soup_trusted_xml', BenchSoupTrustedXML),
+  ('soup_tokenizer', BenchSoupTokenizer),
+  ('subscriptions', BenchSubscriptions),
+  ('import', BenchImport),
+]
+
+
+def main(argv):
+  names = argv[1:]
+  for name, bench in BENCHMARKS:
+    if not names or name in names:
+      bench()
+
+
+if __name__ == "__main__":
+  main(sys.argv)
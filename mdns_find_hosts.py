@@ -0,0 +1,382 @@
+# Copyright (c) 2008, Brandon Long
+# -*- coding: utf-8 -*-
+#
+# A small mDNS/DNS-SD browser, for finding services on the local network
+# without avahi, D-bus or glib.
+#
+# This has the same ReturnHosts, IterServices and get_host calls as
+# avahi_find_hosts, so TivoAccess can use whichever one is available.  It
+# sends one-shot (legacy unicast) queries from an ephemeral port, so it
+# doesn't need to share port 5353 with a running responder, and follows up
+# PTR answers with SRV, TXT and A queries until each service is resolved.
+#
+
+import os
+import re
+import select
+import socket
+import struct
+import time
+
+MDNS_ADDRESS = ('224.0.0.251', 5353)
+
+TYPE_A = 1
+TYPE_PTR = 12
+TYPE_TXT = 16
+TYPE_SRV = 33
+CLASS_IN = 1
+
+# How long to wait before asking again for anything which hasn't answered.
+REQUERY_INTERVAL = 1.0
+# How often a ServiceWatcher asks again about everything, to find new services.
+WATCH_INTERVAL = 30.0
+# How far into its TTL a record is asked about again, so it doesn't expire.
+# Answers to our legacy unicast queries have their TTLs capped at 10 seconds
+# (RFC 6762 section 6.7), so this is usually well before WATCH_INTERVAL.
+REFRESH_FRACTION = 0.8
+
+
+class Service:
+  """A resolved service, with the same attributes as avahi_find_hosts'
+  Service where they make sense."""
+
+  def __init__(self, name, stype, domain, host, address, port, txt):
+    self.name = name
+    self.type = stype
+    self.domain = domain
+    self.host = host
+    self.address = address
+    self.port = port
+    self.txt = txt
+
+  def key(self):
+    return (self.name, self.type, self.domain)
+
+
+def EncodeName(name):
+  labels = [label for label in name.split('.') if label]
+  return ''.join([chr(len(label)) + label for label in labels]) + '\0'
+
+
+def BuildQuery(questions, query_id=0):
+  """Returns a DNS query packet asking each (name, type) in questions."""
+  packet = [struct.pack('!HHHHHH', query_id, 0, len(questions), 0, 0, 0)]
+  for name, qtype in questions:
+    packet.append(EncodeName(name) + struct.pack('!HH', qtype, CLASS_IN))
+  return ''.join(packet)
+
+
+def ReadName(data, offset):
+  """Reads a possibly compressed name at offset in data.  Returns the name and
+  the offset just past it."""
+  labels = []
+  end = None
+  jumps = 0
+  while 1:
+    length = ord(data[offset])
+    if length & 0xC0 == 0xC0:
+      if end is None:
+        end = offset + 2
+      offset = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3FFF
+      jumps += 1
+      if jumps > 32:
+        raise ValueError('Name compression loop')
+      continue
+    offset += 1
+    if length == 0:
+      break
+    labels.append(data[offset:offset + length])
+    offset += length
+  if end is None:
+    end = offset
+  return '.'.join(labels), end
+
+
+def ParseRecords(data):
+  """Parses a DNS response.  Returns a list of (name, type, ttl, value) for
+  the PTR, SRV, TXT and A records in it, where value is the target name for
+  PTR, (port, target) for SRV, a list of strings for TXT and the dotted
+  address for A."""
+  query_id, flags, qdcount, ancount, nscount, arcount = struct.unpack(
+      '!HHHHHH', data[:12])
+  offset = 12
+  for i in range(qdcount):
+    name, offset = ReadName(data, offset)
+    offset += 4
+  records = []
+  for i in range(ancount + nscount + arcount):
+    name, offset = ReadName(data, offset)
+    rtype, rclass, ttl, rdlength = struct.unpack('!HHIH',
+                                                 data[offset:offset + 10])
+    offset += 10
+    rdata = offset
+    offset += rdlength
+    if rtype == TYPE_PTR:
+      value = ReadName(data, rdata)[0]
+    elif rtype == TYPE_SRV:
+      port = struct.unpack('!H', data[rdata + 4:rdata + 6])[0]
+      value = (port, ReadName(data, rdata + 6)[0])
+    elif rtype == TYPE_TXT:
+      value = []
+      pos = rdata
+      while pos < offset:
+        length = ord(data[pos])
+        if length:
+          value.append(data[pos + 1:pos + 1 + length])
+        pos += 1 + length
+    elif rtype == TYPE_A:
+      value = socket.inet_ntoa(data[rdata:rdata + 4])
+    else:
+      continue
+    records.append((name, rtype, ttl, value))
+  return records
+
+
+class RecordCache:
+  """The records we've heard, each kept until its TTL runs out.  A record
+  with a TTL of 0 is a goodbye, and removes it straight away."""
+
+  def __init__(self):
+    # (name, type) -> list of [value, expiry time, refresh time]
+    self.records = {}
+
+  def Add(self, name, rtype, ttl, value, now=None):
+    if now is None:
+      now = time.time()
+    entries = self.records.setdefault((name.lower(), rtype), [])
+    for entry in entries:
+      if entry[0] == value:
+        entries.remove(entry)
+        break
+    if ttl:
+      entries.append([value, now + ttl, now + REFRESH_FRACTION * ttl])
+
+  def Get(self, name, rtype, now=None):
+    if now is None:
+      now = time.time()
+    entries = self.records.get((name.lower(), rtype), [])
+    entries[:] = [entry for entry in entries if entry[1] > now]
+    return [entry[0] for entry in entries]
+
+  def RefreshTime(self, name, rtype, now=None):
+    """Returns when the first of the records for name and rtype should be
+    asked about again, or None if there aren't any."""
+    self.Get(name, rtype, now)
+    entries = self.records.get((name.lower(), rtype))
+    if not entries:
+      return None
+    return min([entry[2] for entry in entries])
+
+
+class Browser:
+  def __init__(self, stype, domain='local', address=MDNS_ADDRESS):
+    self.stype = stype
+    self.domain = domain
+    self.fqtype = '%s.%s' % (stype, domain)
+    self.address = address
+    self.cache = RecordCache()
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.bind(('', 0))
+    self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+    self.query_id = struct.unpack('!H', os.urandom(2))[0]
+    # (name, type) -> when we last asked for it
+    self._asked = {}
+
+  def Close(self):
+    self.sock.close()
+
+  def Ask(self, questions):
+    """Sends a query for each (name, type) in questions that we haven't asked
+    about in the last REQUERY_INTERVAL."""
+    now = time.time()
+    questions = [q for q in questions
+                 if now - self._asked.get(q, 0) >= REQUERY_INTERVAL]
+    if not questions:
+      return
+    for q in questions:
+      self._asked[q] = now
+    self.sock.sendto(BuildQuery(questions, self.query_id), self.address)
+
+  def HandlePacket(self, data):
+    try:
+      records = ParseRecords(data)
+    except (ValueError, IndexError, struct.error):
+      return
+    for name, rtype, ttl, value in records:
+      self.cache.Add(name, rtype, ttl, value)
+
+  def Services(self):
+    """Returns the services we've heard of, and the questions we still need
+    answered to resolve the rest."""
+    services = []
+    questions = []
+    for instance in self.cache.Get(self.fqtype, TYPE_PTR):
+      srv = self.cache.Get(instance, TYPE_SRV)
+      txt = self.cache.Get(instance, TYPE_TXT)
+      if not srv:
+        questions.append((instance, TYPE_SRV))
+      if not txt:
+        questions.append((instance, TYPE_TXT))
+      if not srv or not txt:
+        continue
+      port, target = srv[0]
+      addresses = self.cache.Get(target, TYPE_A)
+      if not addresses:
+        questions.append((target, TYPE_A))
+        continue
+      name = instance[:-len(self.fqtype) - 1]
+      services.append(Service(name, self.stype, self.domain, target,
+                              addresses[0], port, txt[0]))
+    return services, questions
+
+  def RefreshQuestions(self):
+    """Returns the questions to ask to refresh everything we know about."""
+    questions = [(self.fqtype, TYPE_PTR)]
+    for instance in self.cache.Get(self.fqtype, TYPE_PTR):
+      questions.append((instance, TYPE_SRV))
+      questions.append((instance, TYPE_TXT))
+      for port, target in self.cache.Get(instance, TYPE_SRV):
+        questions.append((target, TYPE_A))
+    return questions
+
+  def RefreshTime(self):
+    """Returns when the first of the records RefreshQuestions asks about
+    should be refreshed, or None if we don't know of any."""
+    times = [self.cache.RefreshTime(name, rtype)
+             for name, rtype in self.RefreshQuestions()]
+    times = [t for t in times if t is not None]
+    if not times:
+      return None
+    return min(times)
+
+  def Wait(self, timeout):
+    """Waits up to timeout seconds for responses, and handles them."""
+    readable = select.select([self.sock], [], [], max(timeout, 0))[0]
+    while readable:
+      self.HandlePacket(self.sock.recv(9000))
+      readable = select.select([self.sock], [], [], 0)[0]
+
+
+def service_type(service_name):
+  """Returns the DNS service type to browse for service_name."""
+  if service_name[0] == '_':
+    return service_name
+  return "_%s._tcp" % service_name
+
+
+def get_host(service, use_host_names):
+  """Returns the host name, or IP address if the host name looks suspicious,
+  or is preferred."""
+  if (use_host_names and
+      re.match("^([0-9a-z][0-9a-z\-]*\.)*([0-9a-z][0-9a-z\-]*)\.?",
+               service.host)):
+    return service.host
+  return service.address
+
+
+def IterServices(service_name, timeout=3000, expected=None, domain='local',
+                 address=MDNS_ADDRESS):
+  """Yields each Service advertising service_name as soon as it has been
+  resolved.
+
+  Stops after timeout milliseconds, or once expected services have been
+  found.  address is where to send queries, which is only worth changing to
+  test against a responder somewhere else."""
+  browser = Browser(service_type(service_name), domain, address)
+  fqtype = browser.fqtype
+  deadline = time.time() + timeout / 1000.0
+  found = set()
+  try:
+    while 1:
+      services, questions = browser.Services()
+      for service in services:
+        if service.key() not in found:
+          found.add(service.key())
+          yield service
+          if expected and len(found) >= expected:
+            return
+      browser.Ask([(fqtype, TYPE_PTR)] + questions)
+      wait = min(deadline - time.time(), REQUERY_INTERVAL)
+      if wait <= 0:
+        return
+      browser.Wait(wait)
+  finally:
+    browser.Close()
+
+
+class ServiceWatcher:
+  """Keeps browsing for a service, and tells subscribers as hosts advertising
+  it appear or go away.  A service goes away when its records expire or the
+  host says goodbye.
+
+  The live map of services, by key, is kept in self.services."""
+
+  def __init__(self, service_name, domain='local', address=MDNS_ADDRESS):
+    self.browser = Browser(service_type(service_name), domain, address)
+    self.services = {}
+    self.subscribers = []
+    self.stopped = False
+
+  def Subscribe(self, added=None, removed=None):
+    """Arranges for added(service) and removed(service) to be called as
+    services come and go.  They're called from the thread running Run()."""
+    self.subscribers.append((added, removed))
+
+  def _Update(self, services):
+    current = dict([(service.key(), service) for service in services])
+    for key, service in current.items():
+      if key not in self.services:
+        self.services[key] = service
+        for added, removed in self.subscribers:
+          if added:
+            added(service)
+    for key, service in self.services.items():
+      if key not in current:
+        del self.services[key]
+        for added, removed in self.subscribers:
+          if removed:
+            removed(service)
+
+  def Run(self):
+    """Browses until Stop() is called.
+
+    Everything is asked about again every WATCH_INTERVAL, and as soon as
+    any record we know is REFRESH_FRACTION of the way through its TTL.  A
+    record which doesn't get answered is asked about again every
+    REQUERY_INTERVAL until it expires."""
+    browser = self.browser
+    next_refresh = 0
+    try:
+      while not self.stopped:
+        services, questions = browser.Services()
+        self._Update(services)
+        now = time.time()
+        due = browser.RefreshTime()
+        if now >= next_refresh or (due is not None and now >= due):
+          questions = browser.RefreshQuestions()
+          next_refresh = now + WATCH_INTERVAL
+        browser.Ask(questions)
+        wait = next_refresh - now
+        if due is not None and due > now:
+          wait = min(wait, due - now)
+        browser.Wait(min(wait, REQUERY_INTERVAL))
+    finally:
+      browser.Close()
+
+  def Stop(self):
+    self.stopped = True
+
+
+def ReturnHosts(service_name, return_addrs=True, timeout=3000, expected=None,
+                callback=None):
+  """Returns the hosts advertising service_name.
+
+  If given, callback is called with each host as soon as it is found, before
+  the rest have been.  See IterServices for timeout and expected."""
+  r = []
+  for service in IterServices(service_name, timeout, expected):
+    host = get_host(service, not return_addrs)
+    if callback:
+      callback(host)
+    r.append(host)
+  return r
@@ -0,0 +1,169 @@
+# Copyright (c) 2008, Brandon Long
+# -*- coding: utf-8 -*-
+#
+# Subscriptions say which recordings to archive off the tivos.
+#
+# A subscriptions file has one rule per line.  A line with just some text in
+# it matches any recording with that text in its title.  Otherwise, a line is
+# a list of field=value pairs, quoted like a shell command line, all of which
+# have to match:
+#
+#   South Park
+#   title="The Venture Bros" episode=Pinstripes
+#   title=NHL station=CSNBA after=2009-01-01 before=2009-07-01
+#
+# title and episode match anywhere in the title or episode.
+# channel and station have to match exactly.  after and before are dates,
+# and a recording has to have been captured on or after the after date, and
+# before the before date.
+#
+# All of the titles are compiled into one Aho-Corasick automaton, so matching
+# the playlist takes one pass over each title no matter how many rules there
+# are.
+#
+# The file is UTF-8, and rules are kept as unicode to match the titles in the
+# playlist.
+#
+
+import shlex
+import time
+
+RULE_FIELDS = ('title', 'episode', 'channel', 'station', 'after', 'before')
+
+
+def ParseDate(value):
+  """Returns the local unix time of the start of a YYYY-MM-DD date."""
+  return time.mktime(time.strptime(value, '%Y-%m-%d'))
+
+
+class Rule:
+  def __init__(self, title='', episode='', channel='', station='', after=None,
+               before=None):
+    self.title = title
+    self.episode = episode
+    self.channel = channel
+    self.station = station
+    self.after = after and ParseDate(after)
+    self.before = before and ParseDate(before)
+
+  def __str__(self):
+    return self.title
+
+  def MatchesDetails(self, entry):
+    """Returns whether entry matches everything in the rule but the title."""
+    if self.episode and entry.episode.find(self.episode) == -1:
+      return False
+    if self.channel and entry.channel != self.channel:
+      return False
+    if self.station and entry.station != self.station:
+      return False
+    if self.after and entry.date < self.after:
+      return False
+    if self.before and entry.date >= self.before:
+      return False
+    return True
+
+
+def ParseRule(line):
+  """Parses a line of a subscriptions file, as unicode.  Returns None for
+  blank lines and comments, and raises ValueError for anything it doesn't
+  understand."""
+  line = line.strip()
+  if not line or line.startswith('#'):
+    return None
+  if '=' not in line:
+    return Rule(title=line)
+  fields = {}
+  # shlex only copes with byte strings.
+  for word in shlex.split(line.encode('utf-8')):
+    name, sep, value = word.decode('utf-8').partition('=')
+    if not sep or name not in RULE_FIELDS:
+      raise ValueError('Bad subscription field %r in %r' % (word, line))
+    fields[name] = value
+  return Rule(**fields)
+
+
+class Automaton:
+  """An Aho-Corasick automaton, for finding every one of a set of strings
+  in some text in a single pass."""
+
+  def __init__(self, keywords):
+    """keywords is a list of (string, value) pairs.  Search yields value for
+    each place string occurs."""
+    self.goto = [{}]
+    self.fail = [0]
+    self.out = [[]]
+    for keyword, value in keywords:
+      state = 0
+      for ch in keyword:
+        child = self.goto[state].get(ch)
+        if child is None:
+          child = len(self.goto)
+          self.goto[state][ch] = child
+          self.goto.append({})
+          self.fail.append(0)
+          self.out.append([])
+        state = child
+      self.out[state].append(value)
+
+    # Breadth first, so the failure state of each state's parent is known
+    # before we get to it.
+    queue = self.goto[0].values()
+    while queue:
+      state = queue.pop(0)
+      for ch, child in self.goto[state].items():
+        queue.append(child)
+        fail = self.fail[state]
+        while fail and ch not in self.goto[fail]:
+          fail = self.fail[fail]
+        fail = self.goto[fail].get(ch, 0)
+        self.fail[child] = fail
+        self.out[child] = self.out[child] + self.out[fail]
+
+  def Search(self, text):
+    goto = self.goto
+    fail = self.fail
+    out = self.out
+    state = 0
+    for ch in text:
+      while state and ch not in goto[state]:
+        state = fail[state]
+      state = goto[state].get(ch, 0)
+      for value in out[state]:
+        yield value
+
+
+class Subscriptions:
+  def __init__(self, rules):
+    self.rules = rules
+    self._automaton = Automaton([(rule.title, rule)
+                                 for rule in rules if rule.title])
+    # Rules without a title have to be checked against every entry.
+    self._untitled = [rule for rule in rules if not rule.title]
+
+  def Match(self, entry):
+    """Returns the first rule which matches entry, or None."""
+    for rule in self._automaton.Search(entry.title):
+      if rule.MatchesDetails(entry):
+        return rule
+    for rule in self._untitled:
+      if rule.MatchesDetails(entry):
+        return rule
+    return None
+
+  def Filter(self, entries):
+    """Yields each of entries which matches a rule."""
+    for entry in entries:
+      if self.Match(entry) is not None:
+        yield entry
+
+
+def Load(filename):
+  """Returns the Subscriptions in filename."""
+  rules = []
+  for line in open(filename):
+    rule = ParseRule(line.decode('utf-8'))
+    if rule is not None:
+      rules.append(rule)
+  return Subscriptions(rules)
+
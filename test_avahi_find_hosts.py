@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Tests for avahi_find_hosts.py, against a fake avahi server.  Run with
+# python -m unittest test_avahi_find_hosts
+#
+
+import sys
+import types
+import unittest
+
+
+# Just enough of each module for avahi_find_hosts to import.  The tests hand
+# AvahiServices a fake server, so nothing past the import needs the real ones.
+STUBS = [
+    ('gobject', dict(MainLoop=object, threads_init=lambda: None)),
+    ('dbus', dict(SystemBus=object, Interface=object, UInt32=int)),
+    ('dbus.glib', {}),
+    ('dbus.mainloop', {}),
+    ('dbus.mainloop.glib', dict(threads_init=lambda: None)),
+    ('avahi', dict(IF_UNSPEC=-1, PROTO_UNSPEC=-1,
+                   DBUS_NAME='org.freedesktop.Avahi',
+                   DBUS_PATH_SERVER='/',
+                   DBUS_INTERFACE_SERVER='org.freedesktop.Avahi.Server',
+                   DBUS_INTERFACE_SERVICE_BROWSER=
+                       'org.freedesktop.Avahi.ServiceBrowser',
+                   txt_array_to_string_array=lambda txt: [
+                       ''.join(map(chr, item)) for item in txt])),
+    ('avahi.ServiceTypeDatabase', {}),
+]
+
+
+def _ImportWithStubs():
+  """Imports avahi_find_hosts, standing in for whichever of the avahi, dbus
+  and gobject modules aren't installed.  The stubs, and the module imported
+  with them, are taken back out of sys.modules afterwards so nothing else
+  picks them up."""
+  stubbed = []
+  for name, attrs in STUBS:
+    try:
+      __import__(name)
+    except ImportError:
+      module = types.ModuleType(name)
+      module.__dict__.update(attrs)
+      if '.' in name:
+        parent, child = name.rsplit('.', 1)
+        setattr(sys.modules[parent], child, module)
+      sys.modules[name] = module
+      stubbed.append(name)
+  try:
+    import avahi_find_hosts
+  finally:
+    if stubbed:
+      sys.modules.pop('avahi_find_hosts', None)
+      for name in stubbed:
+        del sys.modules[name]
+  return avahi_find_hosts
+
+
+avahi_find_hosts = _ImportWithStubs()
+
+
+class FakeLoop:
+  def __init__(self):
+    self.quit_called = False
+
+  def quit(self):
+    self.quit_called = True
+
+
+class FakeServer:
+  """Stands in for the avahi server's D-Bus interface.  ResolveService
+  calls are held until the test answers them with Reply or Fail, in
+  whatever order it likes."""
+
+  def __init__(self):
+    # name -> (args, reply_handler, error_handler)
+    self.pending = {}
+
+  def GetVersionString(self):
+    return 'avahi fake'
+
+  def ResolveService(self, interface, protocol, name, stype, domain,
+                     aprotocol, flags, reply_handler, error_handler):
+    self.pending[name] = ((interface, protocol, name, stype, domain),
+                          reply_handler, error_handler)
+
+  def Reply(self, name, address='10.0.0.1'):
+    key, reply_handler, error_handler = self.pending.pop(name)
+    reply_handler(*(key + ('%s.local' % name, 0, address, 443, [], 0)))
+
+  def Fail(self, name):
+    key, reply_handler, error_handler = self.pending.pop(name)
+    error_handler(Exception('Timeout reached'))
+
+
+def ItemKey(name):
+  return (2, 0, name, '_tivo-videos._tcp', 'local')
+
+
+class AvahiServicesTests(unittest.TestCase):
+
+  def setUp(self):
+    self.loop = FakeLoop()
+    self.server = FakeServer()
+    self.browser = avahi_find_hosts.AvahiServices('local', self.loop,
+                                                  bus=object(),
+                                                  server=self.server)
+    self.found = []
+    self.browser.callback = self.found.append
+
+  def New(self, name):
+    self.browser.new_service(*(ItemKey(name) + (0,)))
+
+  def test_finishes_once_resolved(self):
+    self.New('a')
+    self.New('b')
+    self.browser.all_for_now()
+    self.server.Reply('b')
+    self.assertFalse(self.browser.finished)
+    self.server.Reply('a')
+    self.assertTrue(self.browser.finished)
+    self.assertTrue(self.loop.quit_called)
+    self.assertEqual([service.name for service in self.found], ['b', 'a'])
+
+  def test_failed_resolve(self):
+    self.New('a')
+    self.New('b')
+    self.browser.all_for_now()
+    self.server.Fail('a')
+    self.assertFalse(self.browser.finished)
+    self.server.Reply('b')
+    self.assertTrue(self.browser.finished)
+    self.assertEqual(self.browser.services.keys(), [ItemKey('b')])
+
+  def test_failed_then_removed(self):
+    # A service whose resolve failed and which then goes away mustn't be
+    # counted twice, and leave us finishing with a resolve still pending.
+    self.New('a')
+    self.New('b')
+    self.New('c')
+    self.server.Fail('a')
+    self.browser.remove_service(*ItemKey('a'))
+    self.browser.all_for_now()
+    self.server.Reply('b')
+    self.assertFalse(self.browser.finished)
+    self.server.Reply('c')
+    self.assertTrue(self.browser.finished)
+
+  def test_removed_while_resolving(self):
+    removed = []
+    self.browser.remove_callback = removed.append
+    self.New('a')
+    self.browser.remove_service(*ItemKey('a'))
+    self.server.Reply('a')
+    self.assertEqual(self.found, [])
+    self.assertEqual(removed, [])
+    self.New('b')
+    self.server.Reply('b')
+    self.browser.remove_service(*ItemKey('b'))
+    self.assertEqual([service.name for service in removed], ['b'])
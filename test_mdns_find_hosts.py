@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+#
+# Tests for mdns_find_hosts.py, against a responder on loopback which answers
+# like a couple of tivos would.  Run with
+# python -m unittest test_mdns_find_hosts
+#
+
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import mdns_find_hosts
+from mdns_find_hosts import (EncodeName, ParseRecords, TYPE_A, TYPE_PTR,
+                             TYPE_SRV, TYPE_TXT)
+
+FQTYPE = '_tivo-videos._tcp.local'
+
+
+def Record(name, rtype, ttl, rdata):
+  return (EncodeName(name) +
+          struct.pack('!HHIH', rtype, mdns_find_hosts.CLASS_IN, ttl,
+                      len(rdata)) + rdata)
+
+
+def Response(records, query_id=0):
+  return (struct.pack('!HHHHHH', query_id, 0x8400, 0, len(records), 0, 0) +
+          ''.join(records))
+
+
+class Responder:
+  """Answers PTR, SRV, TXT and A queries on 127.0.0.1 for self.services, a
+  map of instance name to (host, address, port, txt)."""
+
+  def __init__(self, ttl=120):
+    self.ttl = ttl
+    self.services = {
+        'Living Room': ('tivo-lr.local', '10.0.0.5', 443,
+                        ['TSN=6500000000000000', 'protocol=https']),
+        'Den': ('tivo-den.local', '10.0.0.6', 443,
+                ['TSN=6500000000000001', 'protocol=https']),
+    }
+    # Each (name, type) asked about, in order.
+    self.questions = []
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.bind(('127.0.0.1', 0))
+    self.address = self.sock.getsockname()
+    thread = threading.Thread(target=self._Serve)
+    thread.daemon = True
+    thread.start()
+
+  def Close(self):
+    self.sock.close()
+
+  def Answers(self, name, qtype, ttl=None):
+    if ttl is None:
+      ttl = self.ttl
+    answers = []
+    if qtype == TYPE_PTR and name.lower() == FQTYPE.lower():
+      for instance in self.services:
+        answers.append(Record(FQTYPE, TYPE_PTR, ttl,
+                              EncodeName('%s.%s' % (instance, FQTYPE))))
+    for instance, (host, address, port, txt) in self.services.items():
+      fqname = '%s.%s' % (instance, FQTYPE)
+      if name.lower() == fqname.lower() and qtype == TYPE_SRV:
+        answers.append(Record(fqname, TYPE_SRV, ttl,
+                              struct.pack('!HHH', 0, 0, port) +
+                              EncodeName(host)))
+      if name.lower() == fqname.lower() and qtype == TYPE_TXT:
+        answers.append(Record(fqname, TYPE_TXT, ttl,
+                              ''.join([chr(len(s)) + s for s in txt])))
+      if name.lower() == host and qtype == TYPE_A:
+        answers.append(Record(host, TYPE_A, ttl, socket.inet_aton(address)))
+    return answers
+
+  def _Serve(self):
+    while 1:
+      try:
+        data, client = self.sock.recvfrom(9000)
+      except socket.error:
+        return
+      query_id, flags, qdcount = struct.unpack('!HHH', data[:6])
+      offset = 12
+      answers = []
+      for i in range(qdcount):
+        name, offset = mdns_find_hosts.ReadName(data, offset)
+        qtype = struct.unpack('!H', data[offset:offset + 2])[0]
+        offset += 4
+        self.questions.append((name, qtype))
+        answers.extend(self.Answers(name, qtype))
+      if answers:
+        self.sock.sendto(Response(answers, query_id), client)
+
+
+class ParseRecordsTests(unittest.TestCase):
+
+  def test_compressed_names(self):
+    # The question's name is at offset 12, and everything after points back
+    # into it, or into names pointing back into it, like a real responder's
+    # answer does.
+    question = EncodeName(FQTYPE) + struct.pack('!HH', TYPE_PTR, 1)
+    data = struct.pack('!HHHHHH', 0, 0x8400, 1, 4, 0, 0) + question
+    ptr_rdata = chr(3) + 'Den' + '\xc0\x0c'
+    data += '\xc0\x0c' + struct.pack('!HHIH', TYPE_PTR, 1, 4500,
+                                     len(ptr_rdata))
+    instance = len(data)
+    data += ptr_rdata
+    # The SRV target's first label is inline, with the rest a pointer to the
+    # "local" of the question, past "_tivo-videos" and "_tcp".
+    local = 12 + 1 + len('_tivo-videos') + 1 + len('_tcp')
+    srv_rdata = (struct.pack('!HHH', 0, 0, 443) + chr(8) + 'tivo-den' +
+                 struct.pack('!H', 0xC000 | local))
+    data += struct.pack('!HHHIH', 0xC000 | instance, TYPE_SRV, 1, 120,
+                        len(srv_rdata))
+    target = len(data) + 6
+    data += srv_rdata
+    data += struct.pack('!HHHIH', 0xC000 | instance, TYPE_TXT, 1, 4500, 9)
+    data += chr(8) + 'TSN=6500'
+    data += struct.pack('!HHHIH', 0xC000 | target, TYPE_A, 1, 120, 4)
+    data += socket.inet_aton('10.0.0.6')
+    self.assertEqual(ParseRecords(data), [
+        (FQTYPE, TYPE_PTR, 4500, 'Den.' + FQTYPE),
+        ('Den.' + FQTYPE, TYPE_SRV, 120, (443, 'tivo-den.local')),
+        ('Den.' + FQTYPE, TYPE_TXT, 4500, ['TSN=6500']),
+        ('tivo-den.local', TYPE_A, 120, '10.0.0.6'),
+    ])
+
+  def test_compression_loop(self):
+    data = (struct.pack('!HHHHHH', 0, 0x8400, 0, 1, 0, 0) + '\xc0\x0c' +
+            struct.pack('!HHIH', TYPE_A, 1, 120, 4) + '\0\0\0\0')
+    self.assertRaises(ValueError, ParseRecords, data)
+
+  def test_skips_other_types(self):
+    data = Response([Record('x.local', 28, 120, '\0' * 16),
+                     Record('x.local', TYPE_A, 120, '\x0a\0\0\x01')])
+    self.assertEqual(ParseRecords(data),
+                     [('x.local', TYPE_A, 120, '10.0.0.1')])
+
+
+class RecordCacheTests(unittest.TestCase):
+
+  def test_expiry(self):
+    cache = mdns_find_hosts.RecordCache()
+    cache.Add('tivo.local', TYPE_A, 10, '10.0.0.5', now=0)
+    self.assertEqual(cache.Get('tivo.local', TYPE_A, now=5), ['10.0.0.5'])
+    self.assertEqual(cache.RefreshTime('tivo.local', TYPE_A, now=5), 8)
+    self.assertEqual(cache.Get('tivo.local', TYPE_A, now=11), [])
+    self.assertEqual(cache.RefreshTime('tivo.local', TYPE_A, now=11), None)
+
+  def test_goodbye(self):
+    cache = mdns_find_hosts.RecordCache()
+    cache.Add('tivo.local', TYPE_A, 10, '10.0.0.5', now=0)
+    cache.Add('TIVO.local', TYPE_A, 0, '10.0.0.5', now=1)
+    self.assertEqual(cache.Get('tivo.local', TYPE_A, now=2), [])
+
+
+class BrowserTests(unittest.TestCase):
+
+  def setUp(self):
+    self.responder = Responder()
+
+  def tearDown(self):
+    self.responder.Close()
+
+  def Names(self, services):
+    return sorted([service.name for service in services])
+
+  def test_iter_services(self):
+    services = list(mdns_find_hosts.IterServices(
+        'tivo-videos', timeout=3000, expected=2,
+        address=self.responder.address))
+    self.assertEqual(self.Names(services), ['Den', 'Living Room'])
+    den = [service for service in services if service.name == 'Den'][0]
+    self.assertEqual((den.host, den.address, den.port, den.txt),
+                     self.responder.services['Den'])
+    self.assertEqual(den.type, '_tivo-videos._tcp')
+
+  def Resolve(self, browser):
+    deadline = time.time() + 3
+    while time.time() < deadline:
+      services, questions = browser.Services()
+      if services and not questions:
+        return services
+      browser.Ask([(browser.fqtype, TYPE_PTR)] + questions)
+      browser.Wait(0.2)
+    self.fail('Services were not resolved')
+
+  def test_ttl_expiry(self):
+    self.responder.ttl = 1
+    browser = mdns_find_hosts.Browser('_tivo-videos._tcp',
+                                      address=self.responder.address)
+    try:
+      self.assertEqual(self.Names(self.Resolve(browser)),
+                       ['Den', 'Living Room'])
+      time.sleep(1.1)
+      self.assertEqual(browser.Services()[0], [])
+    finally:
+      browser.Close()
+
+  def test_goodbye(self):
+    browser = mdns_find_hosts.Browser('_tivo-videos._tcp',
+                                      address=self.responder.address)
+    try:
+      self.Resolve(browser)
+      # The Den says goodbye to its PTR record as it goes away.
+      del self.responder.services['Den']
+      browser.HandlePacket(Response([
+          Record(FQTYPE, TYPE_PTR, 0, EncodeName('Den.' + FQTYPE))]))
+      self.assertEqual(self.Names(browser.Services()[0]), ['Living Room'])
+    finally:
+      browser.Close()
+
+
+class ServiceWatcherTests(unittest.TestCase):
+
+  def setUp(self):
+    # Short TTLs, and so asking again sooner, keep the test quick.
+    self.requery_interval = mdns_find_hosts.REQUERY_INTERVAL
+    mdns_find_hosts.REQUERY_INTERVAL = 0.1
+    self.responder = Responder(ttl=1)
+    self.watcher = mdns_find_hosts.ServiceWatcher(
+        'tivo-videos', address=self.responder.address)
+    self.events = []
+    self.watcher.Subscribe(
+        lambda service: self.events.append(('added', service.name)),
+        lambda service: self.events.append(('removed', service.name)))
+    self.thread = threading.Thread(target=self.watcher.Run)
+    self.thread.start()
+
+  def tearDown(self):
+    self.watcher.Stop()
+    self.thread.join()
+    self.responder.Close()
+    mdns_find_hosts.REQUERY_INTERVAL = self.requery_interval
+
+  def WaitFor(self, events):
+    deadline = time.time() + 3
+    while time.time() < deadline:
+      if sorted(self.events) == sorted(events):
+        return
+      time.sleep(0.05)
+    self.assertEqual(sorted(self.events), sorted(events))
+
+  def test_add_refresh_expire(self):
+    self.WaitFor([('added', 'Den'), ('added', 'Living Room')])
+    # Several TTLs on, the records have been refreshed before expiring, so
+    # nothing has gone away.
+    asked = len(self.responder.questions)
+    time.sleep(2.5)
+    self.assertEqual(sorted(self.events),
+                     [('added', 'Den'), ('added', 'Living Room')])
+    self.assertTrue(
+        len([q for q in self.responder.questions[asked:]
+             if q == (FQTYPE, TYPE_PTR)]) >= 2)
+    self.assertEqual(sorted(self.watcher.services.keys()),
+                     [('Den', '_tivo-videos._tcp', 'local'),
+                      ('Living Room', '_tivo-videos._tcp', 'local')])
+    # The Den stops answering, so its records expire.
+    del self.responder.services['Den']
+    self.WaitFor([('added', 'Den'), ('added', 'Living Room'),
+                  ('removed', 'Den')])
+    self.assertEqual(self.watcher.services.keys(),
+                     [('Living Room', '_tivo-videos._tcp', 'local')])
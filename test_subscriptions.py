@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# Tests for subscriptions.py.  Run with python -m unittest test_subscriptions
+#
+
+import os
+import tempfile
+import unittest
+
+from subscriptions import Automaton, Load, ParseDate, ParseRule, Subscriptions
+
+
+class Entry:
+  def __init__(self, title, episode='', station='', date=0):
+    self.title = title
+    self.episode = episode
+    self.channel = ''
+    self.station = station
+    self.date = date
+
+
+class SubscriptionTests(unittest.TestCase):
+
+  def test_automaton(self):
+    automaton = Automaton([('he', 1), ('she', 2), ('his', 3), ('hers', 4)])
+    self.assertEqual(sorted(automaton.Search('ushers')), [1, 2, 4])
+    self.assertEqual(list(automaton.Search('nothing')), [])
+
+  def test_parse_rule(self):
+    rule = ParseRule('title="The Venture Bros" station=CMDY')
+    self.assertEqual(rule.title, 'The Venture Bros')
+    self.assertEqual(rule.station, 'CMDY')
+    self.assertEqual(ParseRule('South Park').title, 'South Park')
+    self.assertEqual(ParseRule('# comment'), None)
+    self.assertRaises(ValueError, ParseRule, 'bogus=1')
+
+  def test_parse_unicode_rule(self):
+    rule = ParseRule(u'title="Pokémon Journeys" station=KÉTV')
+    self.assertEqual(rule.title, u'Pokémon Journeys')
+    self.assertEqual(rule.station, u'KÉTV')
+
+  def test_match(self):
+    subs = Subscriptions([ParseRule('NHL Hockey'), ParseRule('title=NHL station=B'),
+                          ParseRule('episode=Finale after=2009-01-01')])
+    self.assertTrue(subs.Match(Entry('NHL Hockey', station='A')))
+    self.assertTrue(subs.Match(Entry('NHL', station='B')))
+    self.assertFalse(subs.Match(Entry('nhl', station='B')))
+    self.assertFalse(subs.Match(Entry('NHL', station='A')))
+    finale = Entry('Lost', episode='The Finale', date=ParseDate('2009-05-01'))
+    self.assertTrue(subs.Match(finale))
+    finale.date = ParseDate('2008-05-01')
+    self.assertFalse(subs.Match(finale))
+
+  def test_load_utf8(self):
+    fd, filename = tempfile.mkstemp()
+    try:
+      os.write(fd, u'Pokémon\ntitle=Amélie station=KÉTV\n'.encode('utf-8'))
+      os.close(fd)
+      subs = Load(filename)
+    finally:
+      os.remove(filename)
+    # Playlist titles come from the parser as unicode.
+    self.assertTrue(subs.Match(Entry(u'Pokémon Journeys')))
+    self.assertTrue(subs.Match(Entry(u'Amélie', station=u'KÉTV')))
+    self.assertFalse(subs.Match(Entry(u'Amélie', station=u'KETV')))
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# Tests for the NowPlaying paging in TivoAccess.py, against a fake tivo.  Run
+# with python -m unittest test_tivo_access
+#
+
+import copy
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import TivoAccess
+
+
+def Entry(number):
+  entry = TivoAccess.PlayListEntry()
+  entry.title = 'Show %d' % number
+  entry.url = 'u%d' % number
+  entry.date = 1000 + number
+  return entry
+
+
+class FakeFetcher(TivoAccess.TivoFetcher):
+  """Serves NowPlaying pages from self.recordings, treating AnchorOffset as
+  the 0-based index of the first item like the tivo does."""
+
+  def __init__(self, numbers, **args):
+    TivoAccess.TivoFetcher.__init__(self, 'tivo', 'mak', **args)
+    self.recordings = [Entry(number) for number in numbers]
+    # Items served past this many are left off, like a tivo whose list shrank
+    # partway through the walk.
+    self.limit = None
+
+  def _FetchPage(self, offset, page_size=None, sort_order=None):
+    recordings = self.recordings
+    if sort_order == '!CaptureDate':
+      recordings = sorted(recordings, key=lambda entry: -entry.date)
+    end = offset + (page_size or 16)
+    if self.limit is not None:
+      end = min(end, self.limit)
+    return len(recordings), recordings[offset:end]
+
+
+def Urls(entries):
+  return sorted([entry.url for entry in entries])
+
+
+class IterPlayListTests(unittest.TestCase):
+
+  def test_every_item(self):
+    for workers in (1, 3):
+      fetcher = FakeFetcher(range(100), page_size=16, page_workers=workers)
+      self.assertEqual(Urls(fetcher.IterPlayList()),
+                       Urls(fetcher.recordings))
+
+
+class FetchDeltaTests(unittest.TestCase):
+
+  def setUp(self):
+    self.fetcher = FakeFetcher(range(40), page_size=8)
+    self.known = list(self.fetcher.IterPlayList())
+
+  def Delete(self, number):
+    self.fetcher.recordings = [entry for entry in self.fetcher.recordings
+                               if entry.url != 'u%d' % number]
+
+  def test_nothing_changed(self):
+    entries, added, removed = self.fetcher._FetchDelta(self.known)
+    self.assertEqual((added, removed), ([], []))
+    self.assertEqual(Urls(entries), Urls(self.known))
+
+  def test_add_and_delete(self):
+    self.Delete(1)
+    self.fetcher.recordings.append(Entry(500))
+    entries, added, removed = self.fetcher._FetchDelta(self.known)
+    self.assertEqual(Urls(added), ['u500'])
+    self.assertEqual(Urls(removed), ['u1'])
+    self.assertEqual(Urls(entries), Urls(self.fetcher.recordings))
+
+  def test_delete_oldest(self):
+    self.Delete(0)
+    entries, added, removed = self.fetcher._FetchDelta(self.known)
+    self.assertEqual(Urls(removed), ['u0'])
+    self.assertEqual(Urls(entries), Urls(self.fetcher.recordings))
+
+  def test_walk_cut_short(self):
+    # If the pages run out before the end of the list, the recordings we
+    # didn't get to aren't known to be gone.
+    self.Delete(35)
+    self.fetcher.limit = 20
+    entries, added, removed = self.fetcher._FetchDelta(self.known)
+    self.assertEqual(Urls(removed), ['u35'])
+    self.assertEqual(Urls(entries), Urls(self.fetcher.recordings))
+
+
+def MoveTo(entries, address):
+  """Gives entries the urls a tivo at address would."""
+  for number, entry in enumerate(entries):
+    entry.url = ('http://%s:80/download/Show.TiVo?Container=%%2FNowPlaying'
+                 '&id=%d' % (address, 7000 + number))
+    entry.details_url = ('https://%s/TiVoVideoDetails?id=%d' %
+                         (address, 7000 + number))
+
+
+class AddressChangeTests(unittest.TestCase):
+  """The tivo's snapshot is kept by TSN, and DHCP may have moved it since."""
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.fetcher = FakeFetcher(range(40), page_size=8,
+                               playlist_cache=self.dir)
+    self.fetcher.tivo_host = TivoAccess.TivoHost('10.0.0.5', tsn='TSN1')
+    MoveTo(self.fetcher.recordings, '10.0.0.5')
+    # Copies, since the fake serves the same entries after the move.
+    self.known = [copy.copy(entry) for entry in self.fetcher.IterPlayList()]
+    self.fetcher._WriteSnapshot(40, '0x1', self.known)
+    self.fetcher.tivo_host = TivoAccess.TivoHost('10.0.0.9', tsn='TSN1')
+    MoveTo(self.fetcher.recordings, '10.0.0.9')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_snapshot_urls_follow_the_tivo(self):
+    entries = self.fetcher._ReadSnapshot()[2]
+    self.assertEqual(Urls(entries), Urls(self.fetcher.recordings))
+    self.assertEqual(sorted([entry.details_url for entry in entries]),
+                     sorted([entry.details_url
+                             for entry in self.fetcher.recordings]))
+
+  def test_delta_matches_by_content_id(self):
+    # The known entries still have the old address in their urls.
+    entries, added, removed = self.fetcher._FetchDelta(self.known)
+    self.assertEqual((added, removed), ([], []))
+    self.assertEqual(sorted([entry.ContentId() for entry in entries]),
+                     sorted([entry.ContentId()
+                             for entry in self.fetcher.recordings]))
+
+  def test_content_id(self):
+    entry = self.fetcher.recordings[3]
+    self.assertEqual(entry.ContentId(), '7003')
+    entry.url = 'u3'
+    self.assertEqual(entry.ContentId(), entry.Key())
+
+
+class AdaptPageSizeTests(unittest.TestCase):
+
+  def setUp(self):
+    self.fetcher = FakeFetcher([], adaptive_page_size=True)
+
+  def test_capped_pages_still_shrink(self):
+    # A tivo which caps pages at 50 items, and is slow with them.
+    self.assertEqual(self.fetcher._AdaptPageSize(64, 10.0, 50), 25)
+
+  def test_capped_pages_grow(self):
+    self.assertEqual(self.fetcher._AdaptPageSize(64, 0.1, 50), 100)
+
+  def test_last_page_left_alone(self):
+    self.fetcher._AdaptPageSize(32, 0.5, 32)
+    self.assertEqual(self.fetcher._AdaptPageSize(32, 0.3, 3, last=True), 32)
+
+  def test_iter_keeps_size_over_short_last_page(self):
+    # The first page of 32 comes back quickly, so the second asks for 64,
+    # and only gets the last 38.
+    fetcher = FakeFetcher(range(70), page_size=32, adaptive_page_size=True)
+    self.assertEqual(len(list(fetcher.IterPlayList())), 70)
+    self.assertEqual(fetcher.page_size, 64)
+
+
+class FakeDownloader:
+  def __init__(self, failures):
+    self.tivo_host = TivoAccess.TivoHost('10.0.0.5', tsn='TSN1')
+    self.first_byte_time = None
+    self.failures = failures
+    self.downloaded = []
+
+  def Download(self, entry, destfn):
+    if destfn in self.failures:
+      raise self.failures[destfn]
+    self.downloaded.append(destfn)
+    return True
+
+
+class DownloadSchedulerTests(unittest.TestCase):
+
+  def setUp(self):
+    # The worker reports failures, with their tracebacks.
+    self.stdout, self.stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = StringIO.StringIO()
+
+  def tearDown(self):
+    sys.stdout, sys.stderr = self.stdout, self.stderr
+
+  def test_worker_survives_errors(self):
+    fetcher = FakeDownloader({'a': OSError('rename failed'),
+                              'b': ValueError('bad size')})
+    scheduler = TivoAccess.DownloadScheduler(min_pause=0)
+    results = []
+    def Callback(entry, destfn, ok):
+      results.append((destfn, ok))
+      if destfn == 'c':
+        raise IOError('database is locked')
+    for number, destfn in enumerate('abcd'):
+      scheduler.Add(fetcher, Entry(number), destfn, Callback)
+    scheduler.Wait()
+    self.assertEqual(fetcher.downloaded, ['c', 'd'])
+    self.assertEqual(results, [('a', False), ('b', False), ('c', True),
+                               ('d', True)])
+    self.assertFalse([entry for entry in map(Entry, range(4))
+                      if scheduler.Pending(entry)])
@@ -0,0 +1,118 @@
+# Copyright (c) 2008, Brandon Long
+# -*- coding: utf-8 -*-
+#
+# Incremental parser for the TiVoContainer XML documents returned by the
+# tivo's QueryContainer command.
+#
+# This reads the document straight off the response in blocks with expat, and
+# hands back each <Item> as soon as its end tag is seen, as a flat dict mapping
+# the element path below the Item to its text, ie:
+#   {'Details/Title': u'South Park', 'Links/Content/Url': u'http://...', ...}
+# No tree is built, and nothing is kept for an item once it's been returned.
+#
+# ParseDocument does the same flattening for a whole document, such as the
+# TiVoVideoDetails for a recording.
+#
+
+import xml.parsers.expat
+
+# How much to read from the response at a time.
+READ_SIZE = 16384
+
+
+class ContainerParser:
+  def __init__(self):
+    # Text of the container level elements outside of any Item, by path below
+    # the TiVoContainer, ie 'Details/TotalItems' or 'ItemCount'.
+    self.container = {}
+    # Items which have been completely parsed but not yet returned.
+    self.items = []
+
+    self._path = []
+    self._text = []
+    self._item = None
+
+    self._parser = xml.parsers.expat.ParserCreate()
+    self._parser.buffer_text = True
+    self._parser.StartElementHandler = self._StartElement
+    self._parser.EndElementHandler = self._EndElement
+    self._parser.CharacterDataHandler = self._CharacterData
+
+  def _StartElement(self, name, attrs):
+    self._path.append(name)
+    self._text = []
+    if name == 'Item' and len(self._path) == 2:
+      self._item = {}
+
+  def _EndElement(self, name):
+    path = self._path
+    if self._item is not None:
+      if len(path) == 2:
+        self.items.append(self._item)
+        self._item = None
+      else:
+        self._item['/'.join(path[2:])] = ''.join(self._text)
+    elif len(path) > 1:
+      self.container['/'.join(path[1:])] = ''.join(self._text)
+    path.pop()
+    self._text = []
+
+  def _CharacterData(self, data):
+    self._text.append(data)
+
+  def TotalItems(self):
+    return int(self.container.get('Details/TotalItems', 0))
+
+  def Feed(self, data):
+    self._parser.Parse(data, False)
+
+  def Close(self):
+    self._parser.Parse('', True)
+
+  def ParseFile(self, f, read_size=READ_SIZE):
+    """Reads the document from the file object f, yielding each Item dict as
+    soon as it has been parsed."""
+    while 1:
+      data = f.read(read_size)
+      if data:
+        self.Feed(data)
+      else:
+        self.Close()
+      items, self.items = self.items, []
+      for item in items:
+        yield item
+      if not data:
+        break
+
+
+def ParseDocument(f, read_size=READ_SIZE):
+  """Parses the XML document in the file object f into a dict mapping the path
+  of each element below the root to its text.  Only the first of any repeated
+  elements is kept."""
+  result = {}
+  path = []
+  text = []
+
+  def start(name, attrs):
+    path.append(name)
+    del text[:]
+
+  def end(name):
+    key = '/'.join(path[1:])
+    if key and key not in result:
+      result[key] = ''.join(text)
+    path.pop()
+    del text[:]
+
+  parser = xml.parsers.expat.ParserCreate()
+  parser.buffer_text = True
+  parser.StartElementHandler = start
+  parser.EndElementHandler = end
+  parser.CharacterDataHandler = text.append
+  while 1:
+    data = f.read(read_size)
+    if not data:
+      break
+    parser.Parse(data, False)
+  parser.Parse('', True)
+  return result
@@ -0,0 +1,179 @@
+# Copyright (c) 2008, Brandon Long
+# -*- coding: utf-8 -*-
+#
+# A small keep-alive HTTP transport for talking to a Tivo.
+#
+# urllib2 opens a new connection for every request, and its digest auth
+# handler waits for a 401 challenge on each one before sending the real
+# request.  Against the tivo's slow CPU, that's a TLS handshake and an extra
+# round trip for every NowPlaying page.  DigestTransport keeps one persistent
+# connection per host, remembers the digest challenge from the first 401, and
+# answers it preemptively on later requests with an incrementing nonce count.
+#
+# A transport is not thread safe, use one per thread.  The digest state is
+# kept in a DigestAuth, which is thread safe, so the transports for a tivo can
+# share one and only the first request to the tivo gets a 401.
+#
+
+import hashlib
+import httplib
+import os
+import socket
+import ssl
+import StringIO
+import threading
+import urllib2
+import urlparse
+
+
+class DigestAuth:
+  """The digest challenge each host last sent, and the nonce count used with
+  it, for one username and password."""
+
+  def __init__(self, username, password):
+    self.username = username
+    self.password = password
+    self._lock = threading.Lock()
+    # netloc -> dict of the last digest challenge the host sent
+    self._challenges = {}
+    # netloc -> nonce count used for the current challenge
+    self._nonce_counts = {}
+
+  def Authorization(self, netloc, method, uri):
+    """Returns the digest Authorization header for a request to netloc, using
+    the cached challenge, or None if we don't have one yet."""
+    self._lock.acquire()
+    try:
+      chal = self._challenges.get(netloc)
+      if chal is None:
+        return None
+      nc = self._nonce_counts[netloc] + 1
+      self._nonce_counts[netloc] = nc
+    finally:
+      self._lock.release()
+    realm = chal.get('realm', '')
+    nonce = chal.get('nonce', '')
+    ha1 = hashlib.md5('%s:%s:%s' % (self.username, realm,
+                                    self.password)).hexdigest()
+    ha2 = hashlib.md5('%s:%s' % (method, uri)).hexdigest()
+    fields = [('username', self.username), ('realm', realm), ('nonce', nonce),
+              ('uri', uri)]
+    qop = chal.get('qop')
+    if qop is not None:
+      qop = 'auth'
+      ncvalue = '%08x' % nc
+      cnonce = os.urandom(8).encode('hex')
+      digest = hashlib.md5('%s:%s:%s:%s:%s:%s' % (ha1, nonce, ncvalue,
+                                                  cnonce, qop,
+                                                  ha2)).hexdigest()
+    else:
+      digest = hashlib.md5('%s:%s:%s' % (ha1, nonce, ha2)).hexdigest()
+    fields.append(('response', digest))
+    if 'opaque' in chal:
+      fields.append(('opaque', chal['opaque']))
+    if 'algorithm' in chal:
+      fields.append(('algorithm', chal['algorithm']))
+    header = 'Digest ' + ', '.join(['%s="%s"' % f for f in fields])
+    if qop is not None:
+      header += ', qop=%s, nc=%s, cnonce="%s"' % (qop, ncvalue, cnonce)
+    return header
+
+  def SaveChallenge(self, netloc, response):
+    """Remembers the digest challenge in a 401 response.  Returns False if
+    there wasn't one."""
+    for value in response.msg.getheaders('www-authenticate'):
+      scheme, _, params = value.partition(' ')
+      if scheme.lower() != 'digest':
+        continue
+      chal = urllib2.parse_keqv_list(urllib2.parse_http_list(params))
+      self._lock.acquire()
+      try:
+        self._challenges[netloc] = chal
+        self._nonce_counts[netloc] = 0
+      finally:
+        self._lock.release()
+      return True
+    return False
+
+
+class DigestTransport:
+  def __init__(self, auth, timeout=None):
+    # The DigestAuth to answer challenges with, which may be shared with
+    # other transports.
+    self.auth = auth
+    self.timeout = timeout
+    # (scheme, netloc) -> [connection, last response]
+    self._connections = {}
+
+  def close(self):
+    for conn, response in self._connections.values():
+      conn.close()
+    self._connections = {}
+
+  def _Connection(self, scheme, netloc):
+    """Returns a connection to netloc, and whether it has been used before."""
+    key = (scheme, netloc)
+    if key in self._connections:
+      conn, response = self._connections[key]
+      # We can only reuse the connection once the previous response has been
+      # completely read.
+      if response is None or response.isclosed():
+        return conn, True
+      conn.close()
+    if scheme == 'https':
+      # The tivo's certificate is self signed, there's nothing to verify it
+      # against.
+      if hasattr(ssl, '_create_unverified_context'):
+        conn = httplib.HTTPSConnection(netloc, timeout=self.timeout,
+            context=ssl._create_unverified_context())
+      else:
+        conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+    else:
+      conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+    self._connections[key] = [conn, None]
+    return conn, False
+
+  def _Request(self, scheme, netloc, uri, headers):
+    conn, reused = self._Connection(scheme, netloc)
+    request_headers = dict(headers)
+    auth = self.auth.Authorization(netloc, 'GET', uri)
+    if auth:
+      request_headers['Authorization'] = auth
+    try:
+      conn.request('GET', uri, headers=request_headers)
+      response = conn.getresponse()
+    except (httplib.HTTPException, socket.error):
+      # The tivo may have dropped an idle keep-alive connection, try once
+      # more on a new one.
+      conn.close()
+      del self._connections[(scheme, netloc)]
+      if not reused:
+        raise
+      return self._Request(scheme, netloc, uri, headers)
+    self._connections[(scheme, netloc)][1] = response
+    return response
+
+  def open(self, url, headers={}):
+    """Fetches url, returning the response.  Like urllib2, raises HTTPError
+    for error responses, and the response has the message headers available
+    as .headers."""
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    uri = path or '/'
+    if query:
+      uri += '?' + query
+
+    response = self._Request(scheme, netloc, uri, headers)
+    if response.status == 401:
+      # Either this is the first request, or the nonce went stale.  Either
+      # way, use the new challenge and try once more.
+      response.read()
+      if self.auth.SaveChallenge(netloc, response):
+        response = self._Request(scheme, netloc, uri, headers)
+
+    response.headers = response.msg
+    if response.status >= 400:
+      # Read the body now so the connection can be reused.
+      body = StringIO.StringIO(response.read())
+      raise urllib2.HTTPError(url, response.status, response.reason,
+                              response.msg, body)
+    return response